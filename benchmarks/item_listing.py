@@ -0,0 +1,91 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Item Listing Benchmark
+
+Times Item.find_by_order_id() as the item table grows. With order_id
+leading the primary key the lookup is an index seek, so the time per
+call should stay flat instead of growing with the table.
+
+Usage:
+    python -m benchmarks.item_listing [item counts...]
+
+WARNING: this empties the order and item tables of DATABASE_URI
+"""
+
+import sys
+import statistics
+import time
+from datetime import date
+from wsgi import app
+from service.models import db, Order, Item
+
+ITEMS_PER_ORDER = 10
+REPEAT = 200
+
+
+def fill(item_count: int) -> None:
+    """Replaces the contents of the tables with item_count Items"""
+    db.session.execute(db.text('TRUNCATE item, "order"'))
+    order_count = item_count // ITEMS_PER_ORDER
+    orders = [
+        {
+            "id": order_id,
+            "date": date.today(),
+            "status": 1,
+            "amount": 0,
+            "address": "benchmark",
+            "customer_id": order_id,
+        }
+        for order_id in range(1, order_count + 1)
+    ]
+    db.session.execute(db.insert(Order), orders)
+    items = [
+        {"order_id": order_id, "product_id": product_id, "price": 1, "quantity": 1}
+        for order_id in range(1, order_count + 1)
+        for product_id in range(ITEMS_PER_ORDER)
+    ]
+    db.session.execute(db.insert(Item), items)
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE item"))
+
+
+def time_listing(item_count: int) -> float:
+    """Returns the median seconds to list the Items of one Order"""
+    order_id = item_count // ITEMS_PER_ORDER // 2
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        Item.find_by_order_id(order_id)
+        timings.append(time.perf_counter() - start)
+        db.session.expunge_all()
+    return statistics.median(timings)
+
+
+def main(item_counts: list) -> None:
+    """Runs the benchmark for each table size"""
+    with app.app_context():
+        print(f"{'items':>10} {'median ms':>10}")
+        for item_count in item_counts:
+            fill(item_count)
+            print(f"{item_count:>10} {time_listing(item_count) * 1000:>10.3f}")
+        db.session.execute(db.text('TRUNCATE item, "order"'))
+        db.session.commit()
+
+
+if __name__ == "__main__":
+    main([int(count) for count in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
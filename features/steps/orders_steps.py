@@ -38,29 +38,33 @@ WAIT_TIMEOUT = 60
 def step_impl(context):
     """Delete all Orders and load new ones"""
 
-    # Get a list all of the orders
+    # Get a page of the orders at a time, as listing is paged,
+    # and delete them one by one until none are left
     rest_endpoint = f"{context.base_url}/api/orders"
-    context.resp = requests.get(rest_endpoint, timeout=WAIT_TIMEOUT)
-    expect(context.resp.status_code).equal_to(HTTP_200_OK)
-    # and delete them one by one
-    for order in context.resp.json():
-        context.resp = requests.get(
-            f"{rest_endpoint}/{order['id']}/items", timeout=WAIT_TIMEOUT
-        )
+    while True:
+        context.resp = requests.get(rest_endpoint, timeout=WAIT_TIMEOUT)
         expect(context.resp.status_code).equal_to(HTTP_200_OK)
+        orders = context.resp.json()
+        if not orders:
+            break
+        for order in orders:
+            context.resp = requests.get(
+                f"{rest_endpoint}/{order['id']}/items", timeout=WAIT_TIMEOUT
+            )
+            expect(context.resp.status_code).equal_to(HTTP_200_OK)
+
+            for item in context.resp.json():
+                context.resp = requests.delete(
+                    f"{rest_endpoint}/{order['id']}/items/{item['product_id']}",
+                    timeout=WAIT_TIMEOUT,
+                )
+                expect(context.resp.status_code).equal_to(HTTP_204_NO_CONTENT)
 
-        for item in context.resp.json():
             context.resp = requests.delete(
-                f"{rest_endpoint}/{order['id']}/items/{item['product_id']}",
-                timeout=WAIT_TIMEOUT,
+                f"{rest_endpoint}/{order['id']}", timeout=WAIT_TIMEOUT
             )
             expect(context.resp.status_code).equal_to(HTTP_204_NO_CONTENT)
 
-        context.resp = requests.delete(
-            f"{rest_endpoint}/{order['id']}", timeout=WAIT_TIMEOUT
-        )
-        expect(context.resp.status_code).equal_to(HTTP_204_NO_CONTENT)
-
     # load the database with new orders
     for row in context.table:
         payload = {
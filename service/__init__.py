@@ -38,9 +38,14 @@ def create_app():
 
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
-    from service.models import db
+    from service.models import db, cache, responses
 
     db.init_app(app)
+    db.session.session_factory.configure(
+        expire_on_commit=app.config["EXPIRE_ON_COMMIT"]
+    )
+    cache.configure(app.config["FIND_CACHE_SIZE"], app.config["FIND_CACHE_TTL"])
+    responses.configure(app.config["RESPONSE_CACHE_SIZE"], app.config["FIND_CACHE_TTL"])
 
     # Turn off strict slashes because it violates best practices
     app.url_map.strict_slashes = False
@@ -61,6 +66,17 @@ def create_app():
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
 
+        # Drop what the other workers change from the caches of this one
+        if app.config["CACHE_LISTEN"] and (
+            app.config["FIND_CACHE_SIZE"] > 0 or app.config["RESPONSE_CACHE_SIZE"] > 0
+        ):
+            from service.models.cache import InvalidationListener
+
+            url = db.engine.url.set(drivername="postgresql")
+            listener = InvalidationListener(url.render_as_string(hide_password=False))
+            listener.start()
+            app.extensions["cache_listener"] = listener
+
         app.logger.info(70 * "*")
         app.logger.info("O R D E R   S E R V I C E   R U N N I N G  ".center(70, "*"))
         app.logger.info(70 * "*")
@@ -34,3 +34,79 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to bring the indexes of existing tables up to date
+# Usage:
+#   flask db-indexes
+######################################################################
+@app.cli.command("db-indexes")
+def db_indexes():
+    """
+    Brings the indexes of an existing database in line with the models.
+    db.create_all() only builds them together with new tables, so run
+    this after upgrading a database that already has data in it.
+    """
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        reorder_primary_key(table, inspector.get_pk_constraint(table.name))
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+######################################################################
+# Command to add the columns the models have gained to existing tables
+# Usage:
+#   flask db-columns
+######################################################################
+@app.cli.command("db-columns")
+def db_columns():
+    """
+    Adds the columns of the models that an existing database is missing
+    (e.g. the version of order and item). db.create_all() only builds
+    them together with new tables, so run this after upgrading a database
+    that already has data in it.
+    """
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                add_column(table, column)
+
+
+def add_column(table, column) -> None:
+    """Adds a column to a table, giving the rows already in it its default"""
+    app.logger.info("Adding column %s to %s", column.name, table.name)
+    quote = db.engine.dialect.identifier_preparer.quote
+    definition = db.schema.CreateColumn(column).compile(dialect=db.engine.dialect)
+    with db.engine.begin() as connection:
+        connection.execute(
+            db.text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {definition}")
+        )
+
+
+def reorder_primary_key(table, existing: dict) -> None:
+    """
+    Rebuilds the primary key of a table whose columns are in a different
+    order in the database than in the model (e.g. item was keyed on
+    (product_id, order_id) before order_id was moved to the front)
+    """
+    columns = [column.name for column in table.primary_key.columns]
+    if existing["constrained_columns"] == columns:
+        return
+    app.logger.info("Reordering primary key of %s to %s", table.name, columns)
+    quote = db.engine.dialect.identifier_preparer.quote
+    with db.engine.begin() as connection:
+        connection.execute(
+            db.text(
+                f"ALTER TABLE {quote(table.name)} "
+                f"DROP CONSTRAINT {quote(existing['name'])}, "
+                f"ADD PRIMARY KEY ({', '.join(quote(name) for name in columns)})"
+            )
+        )
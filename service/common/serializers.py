@@ -0,0 +1,142 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: serializers
+
+Serializers compiled once from the flask-restx models
+
+api.marshal() looks up and formats every field of a model again for each
+record it marshals. A Serializer works out once, when it is built, how each
+field is read and converted, so a response is made in one pass over the
+records, the ORM records, Core rows or dictionaries, it is given.
+"""
+from collections.abc import Mapping
+from datetime import date
+from functools import lru_cache
+from flask_restx import fields
+from flask_restx.mask import Mask
+
+
+def iso_date(value):
+    """Formats a date as fields.Date does, leaving one already formatted"""
+    return value.isoformat() if isinstance(value, date) else value
+
+
+# How the value of each type of field is converted, in the order they are tried
+CONVERTERS = (
+    (fields.Boolean, bool),
+    (fields.Integer, int),
+    (fields.Float, float),
+    (fields.Date, iso_date),
+    (fields.String, str),
+)
+
+
+def optional(convert):
+    """Returns convert() for values that are not None, as fields.Raw does"""
+
+    def output(value):
+        return None if value is None else convert(value)
+
+    return output
+
+
+######################################################################
+#  S E R I A L I Z E R
+######################################################################
+class Serializer:
+    """Turns records into the dictionaries api.marshal() would make of them"""
+
+    def __init__(self, model, mask=None):
+        """
+        Compiles the fields of a model into the steps of a serializer
+
+        Args:
+            model (Model): the flask-restx model to serialize
+            mask (Mask): the fields to keep, in the order to keep them, or
+                None for every field of the model
+        """
+        self.model = getattr(model, "resolved", model)
+        if mask is None:
+            mask = {name: True for name in self.model}
+        # as marshal() does, names not in the model are skipped and "*" adds
+        # every field the mask does not name
+        names = [name for name in mask if name in self.model]
+        if "*" in mask:
+            names += [name for name in self.model if name not in names]
+        self.steps = [
+            (name, self.key(name), self.converter(name, mask.get(name, True)))
+            for name in names
+        ]
+
+    def field(self, name):
+        """Returns the named field, made an instance if the model lists a class"""
+        field = self.model[name]
+        return field() if isinstance(field, type) else field
+
+    def key(self, name) -> str:
+        """Returns the key or attribute the named field is read from"""
+        return getattr(self.field(name), "attribute", None) or name
+
+    def converter(self, name, content):
+        """Returns the function that formats the value of the named field"""
+        field = self.field(name)
+        if isinstance(field, fields.List):
+            item = self.field_converter(field.container, content)
+            return optional(lambda values: [item(value) for value in values])
+        return self.field_converter(field, content)
+
+    @staticmethod
+    def field_converter(field, content):
+        """Returns the function that formats one value of a field"""
+        if isinstance(field, fields.Nested):
+            nested = Serializer(field.nested, content if content is not True else None)
+            return optional(nested.one)
+        for kind, convert in CONVERTERS:
+            if isinstance(field, kind):
+                return optional(convert)
+        # any other field is passed through, as fields.Raw does
+        return lambda value: value
+
+    @lru_cache(maxsize=128)
+    def masked(self, mask=None):
+        """
+        Returns the serializer of only the fields in a mask, such as the
+        X-Fields header, compiling it the first time it is asked for
+
+        Args:
+            mask (str): the fields to keep, e.g. "id,items{product_id}"
+        """
+        if not mask:
+            return self
+        return Serializer(self.model, Mask(mask))
+
+    def one(self, record) -> dict:
+        """Serializes one record, which may also be a dictionary"""
+        if isinstance(record, Mapping):
+            get = record.get
+            return {name: convert(get(key)) for name, key, convert in self.steps}
+        return {
+            name: convert(getattr(record, key, None))
+            for name, key, convert in self.steps
+        }
+
+    def __call__(self, data):
+        """Serializes a record, or each record in a list of them"""
+        if isinstance(data, (list, tuple)):
+            one = self.one
+            return [one(record) for record in data]
+        return self.one(data)
@@ -14,6 +14,36 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 # SQLALCHEMY_POOL_SIZE = 2
+# Whether a commit expires the records the session holds, so the next read
+# of one SELECTs it again. Each request has a session of its own, so turning
+# it off only lets a request see the records it loaded as they were then.
+EXPIRE_ON_COMMIT = os.getenv("EXPIRE_ON_COMMIT", "true").lower() in ("true", "yes", "1")
+
+# Size and seconds to live of the cache of records found by key,
+# a size of 0 turns it off
+FIND_CACHE_SIZE = int(os.getenv("FIND_CACHE_SIZE", "4096"))
+FIND_CACHE_TTL = float(os.getenv("FIND_CACHE_TTL", "10"))
+# How many records have their encoded GET responses cached, for as long as
+# FIND_CACHE_TTL, a size of 0 turns it off
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "4096"))
+# How many variants, of fields and media types, are cached per record
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "16"))
+# Whether the cache listens for the keys other workers invalidate
+CACHE_LISTEN = os.getenv("CACHE_LISTEN", "true").lower() in ("true", "yes", "1")
+
+# Listing responses of at least this many bytes, and every export stream, are
+# gzipped at this level (1 fastest to 9 smallest) for clients that accept it
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
+# Request bodies sent with Content-Encoding: gzip are refused if they would
+# gunzip to more than this many bytes
+MAX_DECOMPRESSED_SIZE = int(os.getenv("MAX_DECOMPRESSED_SIZE", str(16 * 1024 * 1024)))
+
+# Seconds the response to a POST with an Idempotency-Key is replayed for
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# Seconds a request holds its Idempotency-Key before a retry may take it over
+IDEMPOTENCY_LEASE = float(os.getenv("IDEMPOTENCY_LEASE", "60"))
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
@@ -4,6 +4,8 @@ Models for order
 All of the models are stored in this package
 """
 
-from .persistent_base import db, DataValidationError
+from .cache import cache, responses
+from .persistent_base import db, DataValidationError, VersionConflictError
 from .order import Order
 from .item import Item
+from .idempotency import IdempotencyKey
@@ -0,0 +1,241 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+In-process caches of the records looked up by key, and of the encoded
+responses they are returned in
+
+Every worker has its own caches. The keys a write invalidates are sent to
+the other workers with Postgres NOTIFY on CHANNEL when it commits, and an
+InvalidationListener in each worker drops them from its caches.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+import psycopg
+
+logger = logging.getLogger("flask.app")
+
+# The Postgres channel that invalidated keys are sent to every worker on
+CHANNEL = "cache_invalidation"
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_PAYLOAD = 7900
+
+
+######################################################################
+#  L R U   C A C H E
+######################################################################
+class LRUCache:
+    """
+    A size bounded cache that drops the least recently used entry when it
+    is full, and whose entries expire ttl seconds after they are put
+
+    Every invalidation bumps the generation, and a value loaded before an
+    invalidation is not put, so a reader that raced with a writer cannot
+    cache what the writer has just changed.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 10.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize: int, ttl: float) -> None:
+        """Sets the size and time to live of the cache, emptying it"""
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._entries.clear()
+
+    def get(self, key):
+        """Returns the value cached under key, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, generation: int) -> None:
+        """Caches value under key unless anything was invalidated since generation"""
+        with self._lock:
+            if self.maxsize <= 0 or generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys) -> None:
+        """Drops the values cached under the keys"""
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix: tuple) -> None:
+        """Drops the values cached under every key that starts with prefix"""
+        length = len(prefix)
+        with self._lock:
+            self.generation += 1
+            for key in [key for key in self._entries if key[:length] == prefix]:
+                del self._entries[key]
+
+    def invalidate_all(self) -> None:
+        """Drops every value, keeping the counters"""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def apply(self, entries: list) -> None:
+        """Drops the keys and prefixes in the entries of a payload made by encode()"""
+        for kind, *key in entries:
+            if kind == "prefix":
+                self.invalidate_prefix(tuple(key))
+            else:
+                self.invalidate(tuple(key))
+
+    def clear(self) -> None:
+        """Drops every value and resets the counters"""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters and the number of entries"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+# The records found by key, shared by every request of this process
+cache = LRUCache()
+
+# The encoded response bodies of the records, under the same keys as the
+# records so that whatever drops a record drops its responses too
+responses = LRUCache()
+
+# Every cache that an invalidated key is dropped from
+CACHES = (cache, responses)
+
+
+def origin() -> str:
+    """Returns the name of this worker that its notifications are sent with"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def encode(keys, prefixes) -> list:
+    """Returns the NOTIFY payloads that carry the keys and prefixes"""
+    entries = [json.dumps(["key", *key]) for key in keys]
+    entries += [json.dumps(["prefix", *prefix]) for prefix in prefixes]
+    head = '{"origin": ' + json.dumps(origin()) + ', "entries": ['
+    payloads = []
+    chunk = []
+    size = len(head) + 2
+    for entry in entries:
+        if chunk and size + len(entry) + 1 > MAX_PAYLOAD:
+            payloads.append(head + ",".join(chunk) + "]}")
+            chunk = []
+            size = len(head) + 2
+        chunk.append(entry)
+        size += len(entry) + 1
+    if chunk:
+        payloads.append(head + ",".join(chunk) + "]}")
+    return payloads
+
+
+######################################################################
+#  I N V A L I D A T I O N   L I S T E N E R
+######################################################################
+class InvalidationListener(threading.Thread):
+    """
+    A background thread that LISTENs on CHANNEL with a connection of its
+    own and drops the keys every notification names from the caches
+
+    Notifications this worker sent itself are skipped, as its own commits
+    have already dropped their keys.
+    Notifications sent while it is not connected are lost, so the caches
+    are emptied each time it (re)connects.
+    """
+
+    def __init__(self, conninfo: str, targets: tuple = CACHES, retry: float = 5.0):
+        super().__init__(name="cache-invalidation-listener", daemon=True)
+        self.conninfo = conninfo
+        self.targets = targets
+        self.retry = retry
+        self.listening = threading.Event()
+        self._stopping = threading.Event()
+
+    def run(self) -> None:
+        """Listens until stop() is called, reconnecting whenever it is cut off"""
+        while not self._stopping.is_set():
+            try:
+                with closing(psycopg.connect(self.conninfo, autocommit=True)) as conn:
+                    conn.execute(f"LISTEN {CHANNEL}")
+                    for target in self.targets:
+                        target.invalidate_all()
+                    self.listening.set()
+                    me = origin()
+                    while not self._stopping.is_set():
+                        for notify in conn.notifies(timeout=1.0):
+                            self.handle(notify.payload, me)
+            except psycopg.Error as error:
+                logger.warning("Cache invalidation listener disconnected: %s", error)
+            self.listening.clear()
+            self._stopping.wait(self.retry)
+
+    def handle(self, payload: str, me: str) -> None:
+        """
+        Drops the keys a notification names from the caches, unless this
+        worker sent it
+
+        A payload that cannot be read is logged and the caches are emptied,
+        as the keys it was meant to drop are not known, and listening goes on
+        """
+        try:
+            message = json.loads(payload)
+            if message["origin"] == me:
+                return
+            for target in self.targets:
+                target.apply(message["entries"])
+        except (ValueError, KeyError, TypeError) as error:
+            logger.error("Malformed cache invalidation %r: %s", payload, error)
+            for target in self.targets:
+                target.invalidate_all()
+
+    def stop(self) -> None:
+        """Stops listening and waits for the thread to finish"""
+        self._stopping.set()
+        self.join()
@@ -0,0 +1,128 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Idempotency Keys of POST requests and the responses they were given
+"""
+
+import logging
+from datetime import timedelta
+from sqlalchemy.dialects.postgresql import insert
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y   M O D E L
+######################################################################
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the Idempotency-Key of a request, and the
+    response to replay when the request is retried with the same key
+
+    A key is claimed before its request is handled, and has no status
+    until the response is stored. A claim only lasts a short lease until
+    then, so a retry can take over the key of a request whose worker died.
+    Keys expire, and the expired ones are deleted as new keys are claimed.
+    """
+
+    # Table Schema
+    key = db.Column(db.String(255), primary_key=True)
+    # a hash of the request, so that a key sent with another request is caught
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer)
+    headers = db.Column(db.JSON)
+    body = db.Column(db.LargeBinary)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} status=[{self.status}]>"
+
+    @classmethod
+    def claim(cls, key: str, fingerprint: str, lease: float):
+        """
+        Claims a key for a request, unless a request that has not expired
+        already claimed it
+
+        Args:
+            key (str): the Idempotency-Key of the request
+            fingerprint (str): the hash of the request
+            lease (float): the seconds the claim lasts if no response is stored
+
+        Returns:
+            None if the key was claimed, or else the IdempotencyKey that has it
+        """
+        logger.info("Claiming idempotency key %s", key)
+        now = db.func.now()
+        claim = insert(cls).values(
+            key=key, fingerprint=fingerprint, expires_at=now + timedelta(seconds=lease)
+        )
+        while True:
+            claimed = db.session.execute(
+                claim.on_conflict_do_update(
+                    index_elements=[cls.key],
+                    set_={
+                        "fingerprint": claim.excluded.fingerprint,
+                        "status": None,
+                        "headers": None,
+                        "body": None,
+                        "expires_at": claim.excluded.expires_at,
+                    },
+                    where=cls.expires_at < now,
+                ).returning(cls.key)
+            ).first()
+            if claimed:
+                # the key just claimed may carry a lease that is already up
+                db.session.execute(
+                    db.delete(cls).where(cls.expires_at < now, cls.key != key)
+                )
+            db.session.commit()
+            if claimed:
+                return None
+            stored = db.session.get(cls, key, populate_existing=True)
+            if stored is not None:
+                return stored
+            # the key was released or deleted since, so it is claimed again
+            logger.info("Idempotency key %s went away, claiming it again", key)
+
+    @classmethod
+    def complete(cls, key: str, response: dict, ttl: float) -> None:
+        """
+        Stores the response to the request that claimed a key, to be
+        replayed until the key expires
+
+        Args:
+            key (str): the Idempotency-Key of the request
+            response (dict): the status, headers and body of the response
+            ttl (float): the seconds until the key expires
+        """
+        logger.info(
+            "Storing the %s response of idempotency key %s", response["status"], key
+        )
+        # a retry that took over the lease may have stored its response
+        stored = db.update(cls).where(cls.key == key, cls.status.is_(None))
+        db.session.execute(
+            stored.values(**response, expires_at=db.func.now() + timedelta(seconds=ttl))
+        )
+        db.session.commit()
+
+    @classmethod
+    def release(cls, key: str) -> None:
+        """Gives up a key whose request failed, so that it can be retried"""
+        logger.info("Releasing idempotency key %s", key)
+        db.session.rollback()
+        db.session.execute(db.delete(cls).where(cls.key == key, cls.status.is_(None)))
+        db.session.commit()
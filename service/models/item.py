@@ -19,10 +19,21 @@ Persistent Base class for database CRUD functions
 """
 
 import logging
-from .persistent_base import db, PersistentBase, DataValidationError
+from sqlalchemy.dialects.postgresql import insert
+from .persistent_base import db, PersistentBase, DataValidationError, set_stored
+from .persistent_base import VersionConflictError, invalidate_on_commit
+from .order import Order
 
 logger = logging.getLogger("flask.app")
 
+# The fields of an Item in the order they are serialized
+ITEM_FIELDS = ("order_id", "product_id", "price", "quantity")
+
+
+def stored_row(new_item) -> list:
+    """Returns the columns of the Item row a statement RETURNING it wrote"""
+    return [new_item.c[key] for key in Item.__table__.columns.keys()]
+
 
 ######################################################################
 #  O R D E R   M O D E L
@@ -33,16 +44,25 @@ class Item(db.Model, PersistentBase):
     """
 
     # Table Schema
-    product_id = db.Column(db.Integer, primary_key=True, nullable=False)
+    # order_id is declared first so that it leads the primary key index,
+    # which every lookup of the Items of an Order can then use
     order_id = db.Column(
         db.Integer,
         db.ForeignKey("order.id", ondelete="CASCADE"),
         primary_key=True,
         nullable=False,
     )
+    product_id = db.Column(db.Integer, primary_key=True, nullable=False)
     price = db.Column(db.Numeric, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
-    order = db.relationship("Order", backref="items", passive_deletes=True)
+    # bumped by every write to the Item, which also bumps the version of its Order
+    version = db.Column(db.Integer, nullable=False, server_default=db.text("1"))
+    # the database deletes the Items of a deleted Order by itself
+    order = db.relationship(
+        "Order", backref=db.backref("items", passive_deletes=True), passive_deletes=True
+    )
+
+    __mapper_args__ = {"version_id_col": version}
 
     def amount(self):
         """
@@ -56,16 +76,15 @@ class Item(db.Model, PersistentBase):
         """
         return f"<Order {self.order_id} Product id=[{self.product_id}]>"
 
-    def serialize(self):
-        """Converts an Order into a dictionary"""
-        item = {
-            "order_id": self.order_id,
-            "product_id": self.product_id,
-            "price": self.price,
-            "quantity": self.quantity,
-        }
+    def serialize(self, fields=None):
+        """Converts an Item into a dictionary
 
-        return item
+        Args:
+            fields (iterable): the names of the fields to include, default all
+        """
+        if fields is None:
+            fields = ITEM_FIELDS
+        return {name: getattr(self, name) for name in fields}
 
     def deserialize(self, data):
         """
@@ -92,55 +111,214 @@ class Item(db.Model, PersistentBase):
 
         return self
 
-    def create(self) -> None:
+    def _insert(self) -> None:
         """
-        Creates an Item to the database
-        """
-        logger.info("Creating %s", self)
+        Inserts the row of this Item, without committing
 
-        try:
-            db.session.add(self)
-            db.session.commit()
-
-            self.order.amount += self.price * self.quantity
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            logger.error("Error creating item: %s", self)
-            raise DataValidationError(e) from e
+        The Item is inserted and its price * quantity is added to the
+        amount of its Order by one statement, so concurrent inserts into
+        the same Order cannot lose each other's updates
+        """
+        new_item = (
+            db.insert(Item)
+            .values(self.serialize())
+            .returning(
+                *Item.__table__.columns,
+                (Item.price * Item.quantity).label("delta"),
+            )
+            .cte("new_item")
+        )
+        total = (
+            db.update(Order)
+            .where(Order.id == new_item.c.order_id)
+            .values(
+                amount=Order.amount + new_item.c.delta,
+                version=Order.version + 1,
+            )
+            .cte("total")
+        )
+        # nothing pending in the session is needed by this statement
+        with db.session.no_autoflush:
+            row = (
+                db.session.execute(db.select(*stored_row(new_item)).add_cte(total))
+                .mappings()
+                .one()
+            )
+        set_stored(self, row)
 
     def update(self) -> None:
         """
         Updates an Item to the database
+
+        The difference between the new and the stored price * quantity is
+        applied to the amount of the Order by the same statement that
+        updates the row, without loading the other Items of the Order
+
+        The row is only updated if it still has the version this Item was
+        read at, and VersionConflictError is raised if it does not
         """
         logger.info("Updating %s", self)
         if not self.order_id:
             raise DataValidationError("Update called with item of empty order id")
-        try:
-            self.order.amount = sum(
-                item.price * item.quantity for item in self.order.items
+        self._write("updating", self._update_row)
+
+    def _update_row(self) -> None:
+        """Writes this Item and the amounts of its Orders and commits them"""
+        # the key the row is stored under, which deserialize() may have changed
+        order_id, product_id = db.inspect(self).identity or (
+            self.order_id,
+            self.product_id,
+        )
+        stored = [Item.order_id == order_id, Item.product_id == product_id]
+        expected = [] if self.version is None else [Item.version == self.version]
+        old_item = (
+            db.select(
+                Item.order_id,
+                Item.product_id,
+                (Item.price * Item.quantity).label("amount"),
+            )
+            .where(*stored, *expected)
+            .with_for_update()
+            .cte("old_item")
+        )
+        new_item = (
+            db.update(Item)
+            .where(
+                Item.order_id == old_item.c.order_id,
+                Item.product_id == old_item.c.product_id,
+            )
+            .values({**self.serialize(), "version": Item.version + 1})
+            .returning(
+                *Item.__table__.columns,
+                (Item.price * Item.quantity).label("amount"),
+                old_item.c.order_id.label("old_order_id"),
+                old_item.c.amount.label("old_amount"),
             )
+            .cte("new_item")
+        )
+        # the new amount is added to the Order the Item is in now and the
+        # old one taken off the Order it was in, which is usually the same
+        changes = db.union_all(
+            db.select(new_item.c.order_id, new_item.c.amount),
+            db.select(new_item.c.old_order_id, -new_item.c.old_amount),
+        ).subquery("changes")
+        delta = (
+            db.select(changes.c.order_id, db.func.sum(changes.c.amount).label("amount"))
+            .group_by(changes.c.order_id)
+            .subquery("delta")
+        )
+        total = (
+            db.update(Order)
+            .where(Order.id == delta.c.order_id)
+            .values(
+                amount=Order.amount + delta.c.amount,
+                version=Order.version + 1,
+            )
+            .cte("total")
+        )
+        with db.session.no_autoflush:
+            row = (
+                db.session.execute(db.select(*stored_row(new_item)).add_cte(total))
+                .mappings()
+                .one_or_none()
+            )
+        if row is None:
+            with db.session.no_autoflush:
+                exists = db.session.scalar(db.select(Item.version).where(*stored))
+            if expected and exists:
+                raise VersionConflictError(f"{self} was changed by someone else")
+            raise DataValidationError(
+                f"Item {product_id} could not be found in order {order_id}"
+            )
+        set_stored(self, row)
+        # the Item may have moved, so both where it was and where it is now go
+        invalidate_on_commit(
+            [
+                Item.cache_key(order_id, product_id),
+                Order.cache_key(order_id),
+                Item.cache_key(self.order_id, self.product_id),
+                Order.cache_key(self.order_id),
+            ]
+        )
+        self._commit_stored()
 
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            logger.error("Error updating item: %s", self)
-            raise DataValidationError(e) from e
+    def _delete_row(self) -> None:
+        """Deletes the row of this Item, taking it off its Order
 
-    def delete(self) -> None:
-        """Removes an Item from the data store"""
-        logger.info("Deleting %s", self)
-        try:
-            self.order.amount -= self.price * self.quantity
-            db.session.add(self.order)
+        The amount is taken off by one UPDATE without loading the Order, which
+        gets a new version even if its amount stays the same
+        """
+        db.session.execute(
+            db.update(Order)
+            .where(Order.id == self.order_id)
+            .values(
+                amount=Order.amount - self.price * self.quantity,
+                version=Order.version + 1,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        super()._delete_row()
+
+    @classmethod
+    def upsert_all(cls, order_id: int, items: list) -> None:
+        """
+        Adds many Items to an Order, replacing the ones it already has
 
-            db.session.delete(self)
+        The Items are written by one INSERT ... ON CONFLICT DO UPDATE and
+        the amount of the Order is then recomputed once, in one transaction
+
+        Args:
+            order_id (int): the id of the Order to add the Items to
+            items (list): the Items to add, whose order_id is ignored
+        """
+        logger.info("Upserting %d items into order %s", len(items), order_id)
+        product_ids = [item.product_id for item in items]
+        if len(set(product_ids)) != len(product_ids):
+            raise DataValidationError("Invalid Items: a product_id is repeated")
+        rows = [{**item.serialize(), "order_id": order_id} for item in items]
+        try:
+            upsert = insert(Item).values(rows)
+            db.session.execute(
+                upsert.on_conflict_do_update(
+                    index_elements=[Item.order_id, Item.product_id],
+                    set_={
+                        "price": upsert.excluded.price,
+                        "quantity": upsert.excluded.quantity,
+                        "version": Item.version + 1,
+                    },
+                )
+            )
+            amount = (
+                db.select(db.func.coalesce(db.func.sum(Item.price * Item.quantity), 0))
+                .where(Item.order_id == order_id)
+                .scalar_subquery()
+            )
+            db.session.execute(
+                db.update(Order)
+                .where(Order.id == order_id)
+                .values(amount=amount, version=Order.version + 1)
+                .execution_options(synchronize_session=False)
+            )
+            invalidate_on_commit(
+                [cls.cache_key(order_id, product_id) for product_id in product_ids]
+                + [Order.cache_key(order_id)]
+            )
             db.session.commit()
         except Exception as e:
             db.session.rollback()
-            logger.error("Error deleting item: %s", self)
+            logger.error("Error upserting items into order %s", order_id)
             raise DataValidationError(e) from e
 
+    def invalidate(self) -> None:
+        """Drops this Item, and the Order whose amount it is part of, from
+        every cache when the session commits"""
+        # an Item written by a statement of its own is not in the session yet
+        identity = db.inspect(self).identity or (self.order_id, self.product_id)
+        if None not in identity:
+            invalidate_on_commit(
+                [self.cache_key(*identity), Order.cache_key(identity[0])]
+            )
+
     ######################################################################
     #  Q U E R Y    F U N C T I O N S
     ######################################################################
@@ -154,9 +332,35 @@ class Item(db.Model, PersistentBase):
         logger.info("Processing order_id query for %s ...", order_id)
         return cls.query.filter(cls.order_id == order_id).all()
 
+    @classmethod
+    def find_serialized(cls, order_ids: list, fields=None, **filters) -> list:
+        """Returns the Items of the given orders already serialized
+
+        The rows are read by a Core SELECT of only the fields and turned
+        straight into the dictionaries serialize() would make, without
+        building Items
+
+        Args:
+            order_ids (list): the ids of the orders whose Items to return
+            fields (iterable): the names of the fields to include, default all
+            **filters: column name / value pairs the Items must also match
+        """
+        logger.info("Processing serialized query for %s %s ...", order_ids, filters)
+        ids = db.bindparam("order_ids", order_ids, type_=db.ARRAY(db.Integer))
+        criteria = [cls.order_id == db.any_(ids)]
+        for name, value in filters.items():
+            criteria.append(cls.__table__.columns[name] == value)
+        statement = (
+            cls.select_fields(fields or ITEM_FIELDS)
+            .where(*criteria)
+            .order_by(cls.order_id, cls.product_id)
+        )
+        return [row._asdict() for row in db.session.execute(statement)]
+
     @classmethod
     def find_by_product_id(cls, order_id, product_id):
-        """Returns items with the given order_id and product_id
+        """Returns items with the given order_id and product_id, from the cache
+        if it is there
 
         Args:
             order_id (Integer): the id of the order you want to match
@@ -165,9 +369,12 @@ class Item(db.Model, PersistentBase):
         logger.info(
             "Processing order_id, product_id query for %s %s ...", order_id, product_id
         )
-        return cls.query.filter(
-            cls.order_id == order_id, cls.product_id == product_id
-        ).first()
+        return cls.cached(
+            (order_id, product_id),
+            lambda: cls.query.filter(
+                cls.order_id == order_id, cls.product_id == product_id
+            ).first(),
+        )
 
     @classmethod
     def find_by_quantity(cls, order_id, quantity):
@@ -20,10 +20,28 @@ Persistent Base class for database CRUD functions
 
 import logging
 from datetime import date
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from .persistent_base import db, PersistentBase, DataValidationError
+from .persistent_base import invalidate_on_commit
 
 logger = logging.getLogger("flask.app")
 
+# The status of an Order that has been cancelled, which it never leaves
+CANCELLED = 0
+
+# How each field of an Order is serialized, so that only the fields
+# asked for are touched
+ORDER_FIELDS = {
+    "id": lambda order: order.id,
+    "date": lambda order: order.date.isoformat(),
+    "status": lambda order: order.status,
+    "amount": lambda order: float(order.amount),
+    "address": lambda order: order.address,
+    "customer_id": lambda order: order.customer_id,
+    # only serialized when asked for, as it needs the Items loaded
+    "items": lambda order: [item.serialize() for item in order.items],
+}
+
 
 ######################################################################
 #  O R D E R   M O D E L
@@ -42,24 +60,42 @@ class Order(db.Model, PersistentBase):
     amount = db.Column(db.Numeric, nullable=False)
     address = db.Column(db.String(64), nullable=False)
     customer_id = db.Column(db.Integer, nullable=False)
+    # bumped by every write to the Order or its Items, which only succeeds
+    # if the version is still the one the Order was read at
+    version = db.Column(db.Integer, nullable=False, server_default=db.text("1"))
+
+    __mapper_args__ = {"version_id_col": version}
+
+    # Listings are filtered and sorted newest first, so each filter column
+    # (and the common customer + status pair) leads an index that is
+    # already in (date, id) order
+    __table_args__ = (
+        db.Index("ix_order_date_id", date.desc(), id.desc()),
+        db.Index("ix_order_status_date_id", status, date.desc(), id.desc()),
+        db.Index("ix_order_address_date_id", address, date.desc(), id.desc()),
+        db.Index("ix_order_customer_id_date_id", customer_id, date.desc(), id.desc()),
+        db.Index(
+            "ix_order_customer_id_status_date_id",
+            customer_id,
+            status,
+            date.desc(),
+            id.desc(),
+        ),
+    )
 
     def __repr__(self):
         return f"<Order {self.id} id=[{self.id}]>"
 
-    def serialize(self):
-        """Converts an Order into a dictionary"""
-        order = {
-            "id": self.id,
-            # Changed from "date": self.date_joined.isoformat(),
-            "date": self.date.isoformat(),
-            "status": self.status,
-            # Changed from "amount": self.amount,
-            "amount": float(self.amount),
-            "address": self.address,
-            "customer_id": self.customer_id,
-        }
-
-        return order
+    def serialize(self, fields=None):
+        """Converts an Order into a dictionary
+
+        Args:
+            fields (iterable): the names of the fields to include, default
+                all of them except the "items" of the Order
+        """
+        if fields is None:
+            fields = [name for name in ORDER_FIELDS if name != "items"]
+        return {name: ORDER_FIELDS[name](self) for name in fields}
 
     def deserialize(self, data):
         """
@@ -84,9 +120,44 @@ class Order(db.Model, PersistentBase):
             raise DataValidationError(
                 "Invalid Order: body of request contained bad or no data " + str(error)
             ) from error
+        except ValueError as error:
+            raise DataValidationError("Invalid Order: " + str(error)) from error
 
         return self
 
+    def create(self) -> None:
+        """
+        Creates an Order, and any Items added to it, in one transaction
+
+        The amount of an Order created with Items is the total of the Items
+        """
+        if self.items:
+            try:
+                self.amount = sum(item.price * item.quantity for item in self.items)
+            except TypeError as error:
+                raise DataValidationError(
+                    "Invalid Order: items must have a numeric price and quantity"
+                ) from error
+        super().create()
+
+    def _insert(self) -> None:
+        """Inserts the Order, and then any Items added to it under its new id"""
+        # read while the new Order still holds them, before it is detached
+        items = self.items
+        super()._insert()
+        if items:
+            for item in items:
+                item.order_id = self.id
+            type(items[0]).insert_rows(items)
+
+    def delete(self) -> None:
+        """Removes an Order, and the Items the database deletes with it"""
+        order_id = db.inspect(self).identity
+        if order_id:
+            item = db.inspect(Order).relationships["items"].mapper.class_
+            invalidate_on_commit(prefixes=[item.cache_key(*order_id)])
+        super().delete()
+
     @classmethod
     def update_amount(cls, order_id, amount):
         """update the amount in an order
@@ -95,60 +166,187 @@ class Order(db.Model, PersistentBase):
             order_id: the id of the order you want to match
         """
         logger.info("Processing order update for %s ...", order_id)
-        return cls.query.filter(cls.id == order_id).update({cls.amount: amount})
+        invalidate_on_commit([cls.cache_key(order_id)])
+        return cls.query.filter(cls.id == order_id).update(
+            {cls.amount: amount, cls.version: cls.version + 1}
+        )
+
+    @classmethod
+    def transition(cls, new_status: int, ids: list = None, **filters) -> list:
+        """
+        Moves the matching Orders that are not cancelled to a new status
+
+        The Orders are changed by one UPDATE ... RETURNING id without being
+        loaded, and the ones already in the new status are left alone
+
+        Args:
+            new_status (int): the status to move the Orders to
+            ids (list): the ids of the Orders to move, or None for any id
+            **filters: column name / value pairs the Orders must also match
+
+        Returns:
+            the ids of the Orders that were moved
+        """
+        logger.info("Moving orders %s %s to status %s", ids, filters, new_status)
+        if ids is None and not filters:
+            raise DataValidationError("Transition called without ids or filters")
+        criteria = cls.criteria(filters)
+        if ids is not None:
+            criteria.append(
+                cls.id == db.any_(db.bindparam("ids", ids, type_=db.ARRAY(db.Integer)))
+            )
+        try:
+            moved = db.session.execute(
+                db.update(cls)
+                .where(*criteria, cls.status != CANCELLED, cls.status != new_status)
+                .values(status=new_status, version=cls.version + 1)
+                .returning(cls.id)
+                .execution_options(synchronize_session=False)
+            )
+            moved_ids = moved.scalars().all()
+            invalidate_on_commit([cls.cache_key(order_id) for order_id in moved_ids])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error moving orders to status %s", new_status)
+            raise DataValidationError(e) from e
+        return moved_ids
 
     ######################################################################
     #  Q U E R Y    F U N C T I O N S
     ######################################################################
     @classmethod
-    def find_by_date(cls, date_obj):
-        """Returns all orders with the given date
+    def query_by(cls, **filters):
+        """Returns a query for the orders matching every filter, newest first
+
+        All of the filters are ANDed into a single WHERE clause, and the
+        result is still a query so callers can narrow it further.
 
         Args:
-            date (date object): the date of the orders you want to match
+            **filters: column name / value pairs, e.g. customer_id=5, status=1
         """
-        logger.info("Processing date query for %s ...", date_obj)
-        return cls.query.filter(cls.date == date_obj).all()
+        logger.info("Processing query for %s ...", filters)
+        return cls.query.filter(*cls.criteria(filters)).order_by(
+            cls.date.desc(), cls.id.desc()
+        )
 
     @classmethod
-    def find_by_address(cls, address):
-        """Returns all orders with the given address
+    def criteria(cls, filters: dict) -> list:
+        """Returns the WHERE criteria for the orders matching every filter
 
         Args:
-            address (string): the address of the orders you want to match
+            filters (dict): column name / value pairs, e.g. customer_id=5, status=1
         """
-        logger.info("Processing address query for %s ...", address)
-        return cls.query.filter(cls.address == address).all()
+        criteria = []
+        for name, value in filters.items():
+            if name not in cls.__table__.columns:
+                raise DataValidationError(f"Invalid filter: {name}")
+            criteria.append(cls.__table__.columns[name] == value)
+        return criteria
 
     @classmethod
-    def find_by_customer_id(cls, customer_id):
-        """Returns all orders with the given customer_id
+    def page_rows(
+        cls, filters: dict, limit: int = None, after: tuple = None, fields=None
+    ) -> list:
+        """Returns the orders matching the filters, newest first, as rows
+
+        Orders are sorted by (date, id) descending in the database, so a
+        page is found by seeking past the key of the last order already
+        returned. The page is read by a Core SELECT of only the columns
+        asked for, so no Order is built. The rows always hold the date and
+        id the next cursor is made from, and serialize_rows() turns them
+        into dictionaries.
 
         Args:
-            customer_id (int): the customer_id of the orders you want to match
+            filters (dict): column name / value pairs the orders must match
+            limit (int): the maximum number of orders to return, or None for all
+            after (tuple): the (date, id) key of the last order of the previous page
+            fields (iterable): the fields that will be serialized, or None for
+                all of the columns
         """
-        logger.info("Processing customer_id query for %s ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id).all()
+        logger.info("Processing page rows for %s after %s ...", filters, after)
+        wanted = set(fields or ORDER_FIELDS) | {"id", "date"}
+        columns = [name for name in cls.__table__.columns.keys() if name in wanted]
+        statement = cls.paged(cls.select_fields(columns), filters, limit, after)
+        return db.session.execute(statement).all()
 
     @classmethod
-    def find_by_status(cls, status):
-        """Returns all orders with the given status
+    def page_tag(cls, filters: dict, limit: int = None, after: tuple = None) -> str:
+        """Returns an MD5 of the ids and versions of the orders on a page, in
+        the order they are listed, which changes whenever an order is added
+        to the page, taken off it or changed, its Items included
+
+        Only the id and version of the orders on the page are read, so a
+        client that already has the page can be told so without reading or
+        serializing the page itself.
 
         Args:
-            status (int): the status of the orders you want to match
+            filters (dict): column name / value pairs the orders must match
+            limit (int): the maximum number of orders on the page, or None for all
+            after (tuple): the (date, id) key of the last order of the previous page
         """
-        logger.info("Processing  status query")
-        return cls.query.filter(cls.status == status).all()
+        page = cls.paged(
+            db.select(cls.id, cls.version, cls.date), filters, limit, after
+        )
+        page = page.subquery("page")
+        pair = db.cast(page.c.id, db.Text) + ":" + db.cast(page.c.version, db.Text)
+        listed = aggregate_order_by(
+            db.literal(","), page.c.date.desc(), page.c.id.desc()
+        )
+        return db.session.scalar(
+            db.select(
+                db.func.coalesce(db.func.md5(db.func.string_agg(pair, listed)), "")
+            )
+        )
 
     @classmethod
-    def find_by_amount(cls, amount):
-        """Returns all orders with the given amount
+    def paged(cls, statement, filters: dict, limit: int = None, after: tuple = None):
+        """Returns a SELECT of orders narrowed to a page of the matching ones,
+        newest first, as page_rows() and page_tag() read them"""
+        statement = statement.where(*cls.criteria(filters)).order_by(
+            cls.date.desc(), cls.id.desc()
+        )
+        if after is not None:
+            statement = statement.where(db.tuple_(cls.date, cls.id) < after)
+        if limit is not None:
+            statement = statement.limit(limit)
+        return statement
+
+    @classmethod
+    def serialize_rows(cls, rows: list, fields=None) -> list:
+        """Converts rows of Orders into dictionaries, as serialize() does
+
+        The Items of all of the Orders are read by one more SELECT when
+        "items" is one of the fields
+
+        Args:
+            rows (list): the rows page_rows() returned
+            fields (iterable): the names of the fields to include, default
+                all of them except the "items" of the Order
+        """
+        if fields is None:
+            fields = [name for name in ORDER_FIELDS if name != "items"]
+        items = {}
+        if "items" in fields:
+            item = db.inspect(cls).relationships["items"].mapper.class_
+            for line in item.find_serialized([row.id for row in rows]):
+                items.setdefault(line["order_id"], []).append(line)
+        serializers = {**ORDER_FIELDS, "items": lambda row: items.get(row.id, [])}
+        return [{name: serializers[name](row) for name in fields} for row in rows]
+
+    @classmethod
+    def stream(cls, filters: dict, batch_size: int = 1000):
+        """Yields every order matching the filters, newest first
+
+        Rows are fetched from a server-side cursor batch_size at a time, so
+        memory stays flat no matter how many orders there are.
 
         Args:
-            amount (Numeric): the amount of the orders you want to match
+            filters (dict): column name / value pairs the orders must match
+            batch_size (int): the number of rows to fetch per round trip
         """
-        logger.info("Processing amount query for %s ...", amount)
-        return cls.query.filter(cls.amount == amount).all()
+        logger.info("Processing stream query for %s ...", filters)
+        yield from cls.query_by(**filters).yield_per(batch_size)
 
     # @classmethod
     # def find_by_name(cls, name):
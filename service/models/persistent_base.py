@@ -20,17 +20,115 @@ Persistent Base class for database CRUD functions
 
 import logging
 from abc import abstractmethod
+from datetime import date
+from decimal import Decimal
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+from .cache import cache, encode, CACHES, CHANNEL
 
 logger = logging.getLogger("flask.app")
 
 db = SQLAlchemy()
 
+# Where the keys to invalidate when a session commits are kept in its info
+STAGED_KEYS = "invalidate"
+
+
+def invalidate_on_commit(keys=(), prefixes=()) -> None:
+    """
+    Drops the keys, and every key that starts with one of the prefixes, from
+    the caches of this and every other worker when the session commits
+    """
+    staged = db.session.info.setdefault(STAGED_KEYS, (set(), set()))
+    staged[0].update(keys)
+    staged[1].update(prefixes)
+
+
+@db.event.listens_for(db.session, "before_commit")
+def notify_invalidations(session):
+    """Sends the staged keys to every worker in the committing transaction,
+    so they are only delivered if it commits"""
+    keys, prefixes = session.info.get(STAGED_KEYS, ((), ()))
+    for payload in encode(keys, prefixes):
+        session.execute(db.select(db.func.pg_notify(CHANNEL, payload)))
+
+
+@db.event.listens_for(db.session, "after_commit")
+def apply_invalidations(session):
+    """Drops the staged keys from the caches of this worker"""
+    keys, prefixes = session.info.pop(STAGED_KEYS, ((), ()))
+    for target in CACHES:
+        if keys:
+            target.invalidate(*keys)
+        for prefix in prefixes:
+            target.invalidate_prefix(prefix)
+
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def drop_invalidations(session, _previous_transaction):
+    """Forgets the staged keys of a transaction that was rolled back"""
+    session.info.pop(STAGED_KEYS, None)
+
+
+def set_stored(record, row) -> None:
+    """Sets the values of a row the database returned on a record, as the
+    values it has stored rather than changes still to write"""
+    for key, value in row.items():
+        set_committed_value(record, key, value)
+
+
+def integer_bound(column_type) -> int:
+    """Returns the bound, exclusive, of the values of an integer column"""
+    if isinstance(column_type, db.BigInteger):
+        return 2**63
+    if isinstance(column_type, db.SmallInteger):
+        return 2**15
+    return 2**31
+
+
+# The values each type of column takes, and what to call them when one does not
+COLUMN_VALUES = (
+    (db.Integer, (int,), "an integer"),
+    (db.Numeric, (int, float, Decimal), "a number"),
+    (db.String, (str,), "a string"),
+    (db.Date, (date,), "a date"),
+)
+
+
+def column_problem(column_type, value):
+    """Returns why a value that is not None does not fit a column of a type,
+    or None if it fits"""
+    for kind, values, name in COLUMN_VALUES:
+        if isinstance(column_type, kind):
+            # a bool is an int to Python but not to the database
+            if isinstance(value, bool) or not isinstance(value, values):
+                return f"must be {name}"
+            return size_problem(column_type, value)
+    return None
+
+
+def size_problem(column_type, value):
+    """Returns why a value of the type of a column is too large for it,
+    or None if it fits"""
+    if isinstance(column_type, db.Integer):
+        bound = integer_bound(column_type)
+        if not -bound <= value < bound:
+            return f"must be from {-bound} to {bound - 1}"
+    elif isinstance(column_type, db.String) and column_type.length:
+        if len(value) > column_type.length:
+            return f"must be at most {column_type.length} characters"
+    return None
+
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
+class VersionConflictError(Exception):
+    """Used when a record was changed since the version a write was based on"""
+
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
@@ -48,46 +146,283 @@ class PersistentBase:
     def deserialize(self, data: dict) -> None:
         """Convert a dictionary into an object"""
 
+    def check_columns(self):
+        """
+        Checks that the values of this record fit the columns they are
+        written to, as the database would, so a bad record can be turned
+        away before a write of many records fails on it
+
+        Returns:
+            this record
+
+        Raises:
+            DataValidationError: when a value does not fit its column
+        """
+        cls = type(self)
+        for key in cls.written_columns():
+            column = cls.__table__.columns[key]
+            value = getattr(self, key)
+            if value is not None:
+                problem = column_problem(column.type, value)
+            elif not column.nullable and column.default is None:
+                problem = "is missing"
+            else:
+                problem = None
+            if problem:
+                raise DataValidationError(f"Invalid {cls.__name__}: {key} {problem}")
+        return self
+
     def create(self) -> None:
         """
         Creates a Account to the database
+
+        The row is written by an INSERT ... RETURNING and the record is set
+        to the row the database stored, so it is not read again afterwards
         """
         logger.info("Creating %s", self)
-        # id must be none to generate next primary key
-        self.id = None
+        self._write("creating", self._create_row)
+
+    def _create_row(self) -> None:
+        """Inserts the row of this record and commits it"""
+        # the id is left to the database, as insert_rows() never writes it
+        self._insert()
+        self.invalidate()
+        self._commit_stored()
+
+    def _insert(self) -> None:
+        """Inserts the row of this record, without committing"""
+        type(self).insert_rows([self])
+
+    @classmethod
+    def create_all(cls, records: list) -> None:
+        """
+        Creates many records in the database in one transaction
+
+        The rows are sent as multi-row INSERT ... RETURNING statements and
+        each record is set to the row stored for it, its new id included
+
+        Args:
+            records (list): the records to create
+        """
+        logger.info("Creating %d %s records", len(records), cls.__name__)
+        if not records:
+            return
         try:
-            db.session.add(self)
+            cls.insert_rows(records)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
-            logger.error("Error creating record: %s", self)
+            logger.error("Error creating %d %s records", len(records), cls.__name__)
             raise DataValidationError(e) from e
 
+    @classmethod
+    def insert_rows(cls, records: list) -> None:
+        """
+        Inserts the rows of many records without committing
+
+        The rows are sent as multi-row INSERT ... RETURNING statements, and
+        each record is set to the row the database stored for it and left
+        detached, as a record that is stored but not in the session
+
+        Args:
+            records (list): the records to insert
+        """
+        columns = cls.written_columns()
+        rows = [{key: getattr(record, key) for key in columns} for record in records]
+        result = db.session.execute(
+            db.insert(cls).returning(
+                *cls.__table__.columns, sort_by_parameter_order=True
+            ),
+            rows,
+        )
+        for record, row in zip(records, result.mappings()):
+            set_stored(record, row)
+            db.make_transient_to_detached(record)
+
+    @classmethod
+    def written_columns(cls) -> list:
+        """Returns the names of the columns a write gives a value, which are
+        all of them but the id and version the database numbers"""
+        version = db.inspect(cls).version_id_col
+        return [
+            column.key
+            for column in cls.__table__.columns
+            if column.key != "id" and column is not version
+        ]
+
     def update(self) -> None:
         """
         Updates a Account to the database
+
+        The columns that were changed are written by an UPDATE ... RETURNING
+        that only matches the row if it still has the version the record was
+        read at, and the record is set to the row the database stored
         """
         logger.info("Updating %s", self)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        try:
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            logger.error("Error updating record: %s", self)
-            raise DataValidationError(e) from e
+        self._write("updating", self._update_row)
+
+    def _update_row(self) -> None:
+        """Writes the changed columns of this record and commits them"""
+        cls = type(self)
+        version = db.inspect(cls).version_id_col
+        state = db.inspect(self)
+        changes = {
+            key: state.attrs[key].value
+            for key in cls.written_columns()
+            if state.attrs[key].history.has_changes()
+        }
+        expected = [] if self.version is None else [version == self.version]
+        self.invalidate()
+        if changes:
+            # the record itself is written by the statement, not a flush
+            with db.session.no_autoflush:
+                row = (
+                    db.session.execute(
+                        db.update(cls)
+                        .where(cls.id == self.id, *expected)
+                        .values({**changes, version.key: version + 1})
+                        .returning(*cls.__table__.columns)
+                        .execution_options(synchronize_session=False)
+                    )
+                    .mappings()
+                    .one_or_none()
+                )
+            if row is None and expected:
+                raise VersionConflictError(f"{self} was changed by someone else")
+            if row is None:
+                raise DataValidationError(f"{self} could not be found")
+            set_stored(self, row)
+        self._commit_stored()
 
     def delete(self) -> None:
         """Removes a Account from the data store"""
         logger.info("Deleting %s", self)
+        self._write("deleting", self._delete_row)
+
+    def _delete_row(self) -> None:
+        """Deletes the row of this record and commits it"""
+        self.invalidate()
+        db.session.delete(self)
+        db.session.commit()
+
+    def _write(self, action: str, write) -> None:
+        """
+        Runs write(), which writes this record and commits, and rolls the
+        session back if it fails
+
+        A record whose version has moved on raises VersionConflictError, and
+        any other failure DataValidationError. A record that was being
+        created is left transient, so it can be created again.
+
+        Args:
+            action (str): what write() does, e.g. "creating", for the log
+            write (callable): writes this record and commits
+        """
         try:
-            db.session.delete(self)
-            db.session.commit()
+            write()
+        except VersionConflictError:
+            db.session.rollback()
+            raise
+        except StaleDataError as e:
+            db.session.rollback()
+            raise VersionConflictError(f"{self} was changed by someone else") from e
         except Exception as e:
+            if action == "creating":
+                db.make_transient(self)
             db.session.rollback()
-            logger.error("Error deleting record: %s", self)
+            logger.error("Error %s record: %s", action, self)
             raise DataValidationError(e) from e
 
+    def _commit_stored(self) -> None:
+        """
+        Commits the session with this record tracked as stored with its
+        current values
+
+        Used once the row has been written, by a statement of its own, and
+        the record set to the row INSERT/UPDATE ... RETURNING gave back. The
+        session does not write the record again, and the values are set
+        back after the commit expires them, so serializing the record does
+        not SELECT the row again.
+        """
+        columns = db.inspect(self).mapper.column_attrs
+        values = {column.key: getattr(self, column.key) for column in columns}
+        if self in db.session:
+            db.session.expunge(self)
+        db.make_transient(self)
+        db.make_transient_to_detached(self)
+        db.session.add(self)
+        db.session.commit()
+        set_stored(self, values)
+
+    def invalidate(self) -> None:
+        """Drops this record, and anything cached that depends on it, from
+        every cache when the session commits"""
+        # the identity is read from the state so that an expired record is not
+        # loaded again just to be dropped
+        identity = db.inspect(self).identity
+        if identity:
+            invalidate_on_commit([self.cache_key(*identity)])
+
+    @classmethod
+    def cache_key(cls, *ident) -> tuple:
+        """Returns the key a record with the given primary key is cached under"""
+        return (cls.__name__, *ident)
+
+    @classmethod
+    def cached(cls, ident: tuple, load):
+        """
+        Returns the record with the primary key ident from the session or the
+        cache, or else the one load() returns
+
+        Only the column values are cached. A hit builds a new record from
+        them and merges it into the session without a query, so callers get
+        a record they can update or delete like any other.
+
+        Args:
+            ident (tuple): the primary key of the record
+            load (callable): loads the record from the database, or returns None
+        """
+        # a record the session already holds may have changes of its own
+        record = db.session.identity_map.get(
+            db.inspect(cls).identity_key_from_primary_key(ident)
+        )
+        if record is not None and not db.inspect(record).expired_attributes:
+            return record
+        key = cls.cache_key(*ident)
+        values = cache.get(key)
+        if values is not None and record is not None:
+            # refreshed without history, so the session has nothing to write
+            for name, value in values.items():
+                set_committed_value(record, name, value)
+            return record
+        if values is not None:
+            record = cls(**values)
+            db.make_transient_to_detached(record)
+            return db.session.merge(record, load=False)
+        generation = cache.generation
+        record = load()
+        if record is not None:
+            columns = db.inspect(cls).column_attrs
+            values = {column.key: getattr(record, column.key) for column in columns}
+            cache.put(key, values, generation)
+        return record
+
+    @classmethod
+    def select_fields(cls, fields):
+        """Returns a Core SELECT of only the named columns
+
+        Its rows are plain named tuples, which are not built into records,
+        put in the identity map or tracked for changes, so they suit reads
+        that are only serialized. The rows can be read like records, by
+        the attribute of each column.
+
+        Args:
+            fields (iterable): the names of the columns to select
+        """
+        return db.select(*(cls.__table__.columns[name] for name in fields))
+
     @classmethod
     def all(cls):
         """Returns all of the records in the database"""
@@ -97,7 +432,8 @@ class PersistentBase:
 
     @classmethod
     def find(cls, by_id):
-        """Finds a record by it's ID"""
+        """Finds a record by it's ID, from the cache if it is there"""
         logger.info("Processing lookup for id %s ...", by_id)
+        ident = by_id if isinstance(by_id, tuple) else (by_id,)
         # pylint: disable=no-member
-        return cls.query.session.get(cls, by_id)
+        return cls.cached(ident, lambda: cls.query.session.get(cls, by_id))
@@ -20,27 +20,47 @@ Order Service with Swagger
 Paths:
 ------ Order ------
 GET / - Displays a UI for Selenium testing
-GET /orders - Returns a list all of the Orders
-GET /orders/{order_id} - Returns the Order with a given id number
-POST /orders - creates a new Order record in the database
+GET /orders - Returns a list all of the Orders, a page of ?limit (100 by default) at a time with ?cursor
+GET /orders/export - Streams all of the Orders as newline-delimited JSON
+GET /orders/{order_id} - Returns the Order with a given id number, and its Items with ?expand=items
+POST /orders - creates a new Order record in the database, with its Items if it lists them
+POST /orders/batch - creates many Order records in the database at once
 PUT /orders/{order_id} - updates a Order record in the database
 DELETE /orders/{id} - deletes an Order record in the database
 PUT /orders/{order_id}/cancel - cancel an Order
+PUT /orders/cancel - cancels the Orders with the given ids or matching the query
+PUT /orders/status - moves the Orders with the given ids or matching the query to a status
 ------ Item ------
 GET /orders/{order_id}/items - Returns a list all of the items of an order
 GET /orders/{order_id}/items/{product_id} - Returns the item with the given order id and product id
 POST /orders/{order_id}/items - creates a new Item record in the database
+POST /orders/{order_id}/items/batch - adds or replaces many Items of an Order at once
 PUT /orders/{order_id}/items/{product_id} - updates an Item record in the database
 DELETE /orders/{order_id}/items/{product_id} - deletes an Order record in the database
 """
 
-from datetime import datetime
-from flask import jsonify, request
+# pylint: disable=too-many-lines
+import base64
+import functools
+import hashlib
+import json
+import zlib
+from datetime import date, datetime
+import msgpack
+from flask import Response, jsonify, make_response, request, stream_with_context
 from flask import current_app as app  # Import Flask application
 from flask_restx import Api, Resource, fields, reqparse
+from flask_restx.mask import Mask, ParseError
+from flask_restx.utils import unpack
+from werkzeug.http import quote_etag
 from service.models import Order
 from service.models import Item
+from service.models import DataValidationError
+from service.models import IdempotencyKey
+from service.models import cache, responses
+from service.models.order import CANCELLED
 from service.common import status  # HTTP Status Codes
+from service.common.serializers import Serializer
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -56,14 +76,37 @@ api = Api(
     prefix="/api",
 )
 
+# The media types request bodies can be sent in, and responses negotiated to
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+BODY_TYPES = (JSON, MSGPACK)
+# The Content-Encodings request bodies can be sent in
+BODY_ENCODINGS = ("identity", "gzip")
+
+
+@api.representation(MSGPACK)
+def output_msgpack(data, code, headers=None):
+    """Makes a MessagePack response, for requests that Accept it"""
+    response = make_response(msgpack.packb(data), code)
+    response.headers.extend(headers or {})
+    return response
+
 
 ######################################################################
 # HEALTH CHECK
 ######################################################################
 @app.route("/health")
 def health_check():
-    """Let them know our heart is still beating"""
-    return jsonify(status=200, message="Healthy"), status.HTTP_200_OK
+    """Let them know our heart is still beating, and how the caches are doing"""
+    return (
+        jsonify(
+            status=200,
+            message="Healthy",
+            cache=cache.stats(),
+            responses=responses.stats(),
+        ),
+        status.HTTP_200_OK,
+    )
 
 
 ######################################################################
@@ -75,6 +118,9 @@ def index():
     return app.send_static_file("index.html")
 
 
+# The statuses an Order can have, as described by create_model
+ORDER_STATUSES = range(4)
+
 # Define the model so that the docs reflect what can be sent
 create_model = api.model(
     "Order",
@@ -92,6 +138,32 @@ create_model = api.model(
     },
 )
 
+# one line of the Items of an Order, which is given by the path or parent
+item_line_model = api.model(
+    "ItemLineModel",
+    {
+        "product_id": fields.Integer(
+            required=True, description="The product id of this item"
+        ),
+        "price": fields.Float(required=True, description="The price of the item"),
+        "quantity": fields.Integer(
+            required=True, description="The quantity of the item"
+        ),
+    },
+)
+
+# an Order to create together with its Items
+create_items_model = api.inherit(
+    "OrderWithItems",
+    create_model,
+    {
+        "items": fields.List(
+            fields.Nested(item_line_model),
+            description="The items of the order, whose total becomes its amount",
+        ),
+    },
+)
+
 order_model = api.inherit(
     "OrderModel",
     create_model,
@@ -102,6 +174,306 @@ order_model = api.inherit(
     },
 )
 
+
+# the outcome of one Order of a batch, in the position it was posted in
+batch_result_model = api.model(
+    "OrderBatchResult",
+    {
+        "status": fields.Integer(
+            description="201 if the order was created, 400 if it was not valid"
+        ),
+        "id": fields.Integer(description="The id of the created order"),
+        "error": fields.String(description="Why the order was not valid"),
+    },
+)
+
+
+def field_list(names):
+    """
+    Returns a parser for a comma separated list of field names.
+    The parser raises a ValueError for any name that is not one of names.
+    """
+
+    def parse(value):
+        selected = [name.strip() for name in value.split(",") if name.strip()]
+        unknown = [name for name in selected if name not in names]
+        if unknown or not selected:
+            raise ValueError(
+                f"Invalid fields: '{value}'. Expected some of: {', '.join(names)}"
+            )
+        return selected
+
+    return parse
+
+
+def item_lines(data, order_id=None) -> list:
+    """
+    Deserializes a list of Item lines into Items of the given Order
+    Raises a DataValidationError if any of the lines is not valid
+    """
+    if not isinstance(data, list):
+        raise DataValidationError("Invalid Items: items must be a list")
+    items = []
+    for line in data:
+        if not isinstance(line, dict):
+            raise DataValidationError("Invalid Item: each item must be an object")
+        items.append(Item().deserialize({**line, "order_id": order_id}))
+    return items
+
+
+def marshal_fields(data, model, selected):
+    """
+    Marshals data with the model, keeping only the selected fields
+
+    The records are serialized in one pass by the Serializer compiled from
+    the model, which makes what api.marshal() would of the records themselves
+    """
+    mask = ",".join(selected) if selected else request.headers.get("X-Fields")
+    return SERIALIZERS[model.name].masked(mask)(data)
+
+
+def fields_variant(selected):
+    """
+    Returns the fields a response is made of, as the variant it is cached
+    under: the fields asked for, or else the X-Fields mask, parsed so that
+    masks that only differ in how they are written are the same variant
+    """
+    if selected:
+        return tuple(selected)
+    mask = request.headers.get(app.config["RESTX_MASK_HEADER"])
+    if not mask:
+        return None
+    try:
+        return str(Mask(mask))
+    except ParseError:
+        # the response will fail to be made, so it is never cached
+        return mask
+
+
+def response_mediatype() -> str:
+    """Returns the media type the Accept header of the request asks for"""
+    return request.accept_mimetypes.best_match(
+        api.representations, default=api.default_mediatype
+    )
+
+
+def cached_response(key, variant, render):
+    """
+    Returns the 200 response of the record cached under key, encoding what
+    render() returns for it only if this variant of the response is not cached
+
+    render() returns the data and the version of the record, which the ETag
+    of the response is made from. The encoded bodies are dropped whenever the
+    record is invalidated, and the variant tells apart the responses of
+    different fields and media types
+    """
+    mediatype = response_mediatype()
+    variant = (mediatype, variant)
+    generation = responses.generation
+    bodies = responses.get(key) or {}
+    if variant not in bodies:
+        data, version = render()
+        body = api.representations[mediatype](data, status.HTTP_200_OK).get_data()
+        bodies = {**bodies, variant: (body, variant_etag(version, variant))}
+        # the oldest variants go, so no client can grow the entry without bound
+        limit = max(app.config["RESPONSE_CACHE_VARIANTS"], 1)
+        bodies = dict(list(bodies.items())[-limit:])
+        responses.put(key, bodies, generation)
+    body, etag = bodies[variant]
+    response = app.response_class(body, status=status.HTTP_200_OK, mimetype=mediatype)
+    response.set_etag(etag)
+    response.vary.update(("Accept", app.config["RESTX_MASK_HEADER"]))
+    return response.make_conditional(request)
+
+
+def version_etag(version) -> dict:
+    """Returns the ETag header of a record at a version"""
+    return {"ETag": quote_etag(str(version))}
+
+
+def variant_etag(version, variant) -> str:
+    """
+    Returns the strong ETag of one variant of the response of a record
+
+    The whole record as JSON is tagged with its version alone, as the
+    responses to writes are, and any other variant with the version and a
+    digest of the variant, e.g. "3-1a2b3c4d", as their bodies differ
+    """
+    if variant == (JSON, None):
+        return str(version)
+    digest = hashlib.md5(repr(variant).encode(), usedforsecurity=False)
+    return f"{version}-{digest.hexdigest()[:8]}"
+
+
+def etag_version(etag: str) -> str:
+    """Returns the version a record ETag was made from, without its variant"""
+    return etag.partition("-")[0]
+
+
+# The headers of a response that are replayed with its body
+REPLAYED_HEADERS = ("Content-Type", "Location", "ETag", "Link")
+
+
+def idempotent(post):
+    """
+    Makes a POST handler replay the response it gave to the first request
+    with the same Idempotency-Key header, instead of handling a retry again
+
+    A retry that arrives while the first request is still being handled is
+    answered with 409 Conflict, and a key sent with a different request with
+    422 Unprocessable Entity. Once IDEMPOTENCY_LEASE has passed without a
+    response, a retry is handled in place of the first request. Responses
+    to requests that failed with an error are not stored, so those requests
+    can be retried.
+    """
+
+    @functools.wraps(post)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return post(*args, **kwargs)
+        if not 0 < len(key) <= 255:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                "Idempotency-Key must be 1 to 255 characters long",
+            )
+        request_hash = hashlib.sha256(request.method.encode())
+        request_hash.update(request.path.encode())
+        # the same request gzipped or not is the same request
+        request_hash.update(request_body())
+        fingerprint = request_hash.hexdigest()
+        stored = IdempotencyKey.claim(key, fingerprint, app.config["IDEMPOTENCY_LEASE"])
+        if stored is not None:
+            return replay(stored, fingerprint)
+        try:
+            response = api.make_response(*unpack(post(*args, **kwargs)))
+        except Exception:
+            IdempotencyKey.release(key)
+            raise
+        headers = {
+            name: response.headers[name]
+            for name in REPLAYED_HEADERS
+            if name in response.headers
+        }
+        stored = {
+            "status": response.status_code,
+            "headers": headers,
+            "body": response.get_data(),
+        }
+        IdempotencyKey.complete(key, stored, app.config["IDEMPOTENCY_TTL"])
+        return response
+
+    return api.doc(
+        params={
+            "Idempotency-Key": {
+                "in": "header",
+                "type": "string",
+                "description": "Replays the first response to a request with this key",
+            }
+        }
+    )(wrapper)
+
+
+def replay(stored, fingerprint: str):
+    """Returns the stored response to a request with the same Idempotency-Key"""
+    if stored.fingerprint != fingerprint:
+        abort(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            f"Idempotency-Key '{stored.key}' was sent with a different request",
+        )
+    if stored.status is None:
+        abort(
+            status.HTTP_409_CONFLICT,
+            f"The request with Idempotency-Key '{stored.key}' is still in progress",
+        )
+    app.logger.info("Replaying the response to Idempotency-Key %s", stored.key)
+    response = app.response_class(
+        stored.body, status=stored.status, headers=stored.headers
+    )
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def list_etag(tag) -> str:
+    """
+    Returns the ETag of a list response, made of a tag that changes whenever
+    the listed rows do and of the parts of the request that shape the body:
+    its query, its X-Fields header and the media type it is answered in
+    """
+    etag = hashlib.md5(usedforsecurity=False)
+    for part in (
+        tag,
+        request.full_path,
+        request.headers.get(app.config["RESTX_MASK_HEADER"]),
+        response_mediatype(),
+    ):
+        etag.update(repr(part).encode())
+    return etag.hexdigest()
+
+
+def not_modified(etag):
+    """
+    Returns a 304 Not Modified response when the If-None-Match of the
+    request has the ETag, or None when the response has to be made
+    """
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = app.response_class(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    response.vary.update(("Accept", app.config["RESTX_MASK_HEADER"]))
+    return response
+
+
+def compressed(get):
+    """
+    Makes a GET handler gzip the 200 responses it returns for clients that
+    send Accept-Encoding: gzip
+
+    Bodies smaller than COMPRESS_MIN_SIZE are sent as they are, and streamed
+    bodies are compressed as they are streamed. The ETag of a compressed
+    response is made weak, as its bytes are not those of the one it tags.
+    """
+
+    @functools.wraps(get)
+    def wrapper(*args, **kwargs):
+        response = get(*args, **kwargs)
+        response.vary.add("Accept-Encoding")
+        if (
+            response.status_code != status.HTTP_200_OK
+            or request.accept_encodings["gzip"] <= 0
+            or "Content-Encoding" in response.headers
+        ):
+            return response
+        level = app.config["COMPRESS_LEVEL"]
+        if response.is_streamed:
+            response.response = gzip_stream(response.iter_encoded(), level)
+        elif response.calculate_content_length() >= app.config["COMPRESS_MIN_SIZE"]:
+            response.set_data(b"".join(gzip_stream([response.get_data()], level)))
+        else:
+            return response
+        response.headers["Content-Encoding"] = "gzip"
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    return wrapper
+
+
+# The window bits zlib writes a gzip header and trailer with
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def gzip_stream(chunks, level: int):
+    """Yields the chunks of a streamed body gzipped, as they are streamed"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 # query string arguments
 order_args = reqparse.RequestParser()
 order_args.add_argument(
@@ -140,6 +512,109 @@ order_args.add_argument(
     help="List Orders by date",
 )
 
+# Largest page of Orders that can be requested at once, and the page size
+# used when no limit is given, so a listing never reads the whole table
+MAX_PAGE_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+
+
+def valid_limit(value):
+    """
+    Parses a string value into a page size.
+    Raises a ValueError if it is not between 1 and MAX_PAGE_SIZE.
+    """
+    limit = int(value)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"Invalid limit: '{value}'. Expected 1 to {MAX_PAGE_SIZE}")
+    return limit
+
+
+def encode_cursor(order):
+    """Returns an opaque cursor pointing just past the given Order"""
+    key = json.dumps([order.date.isoformat(), order.id])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def valid_cursor(value):
+    """
+    Parses an opaque cursor back into the (date, id) key it points after.
+    Raises a ValueError if the cursor was not issued by this service.
+    """
+    try:
+        order_date, order_id = json.loads(base64.urlsafe_b64decode(value))
+        return date.fromisoformat(order_date), int(order_id)
+    except (ValueError, TypeError) as exc:
+        raise ValueError(f"Invalid cursor: '{value}'") from exc
+
+
+order_args.add_argument(
+    "limit",
+    type=valid_limit,
+    location="args",
+    required=False,
+    default=DEFAULT_PAGE_SIZE,
+    help="Return at most this many Orders per page",
+)
+order_args.add_argument(
+    "cursor",
+    type=valid_cursor,
+    location="args",
+    required=False,
+    help="Return the page of Orders after this cursor",
+)
+order_args.add_argument(
+    "fields",
+    type=field_list(list(order_model.resolved)),
+    location="args",
+    required=False,
+    help="Return only these comma separated fields of each Order",
+)
+
+# query string arguments for a single Order
+order_get_args = reqparse.RequestParser()
+order_get_args.add_argument(
+    "expand",
+    type=field_list(["items"]),
+    location="args",
+    required=False,
+    help="Embed the Items in each Order",
+)
+order_args.add_argument(order_get_args.args[0])
+
+# exports stream every matching Order, so they are not paged
+export_args = order_args.copy()
+export_args.remove_argument("limit")
+export_args.remove_argument("cursor")
+export_args.remove_argument("fields")
+export_args.remove_argument("expand")
+
+# query string arguments for choosing the Orders to move to another status
+transition_args = export_args.copy()
+
+
+def order_fields(args):
+    """
+    Returns the Order fields to serialize for the parsed query arguments,
+    and the model to marshal them with
+    """
+    selected = args.get("fields")
+    if not args["expand"]:
+        return selected, order_model
+    selected = (selected or list(order_model.resolved)) + args["expand"]
+    return selected, order_items_model
+
+
+def order_filters(args) -> dict:
+    """Returns the column filters supplied in the parsed query arguments"""
+    # Every filter supplied narrows the same query
+    filters = {
+        name: args[name]
+        for name in ("date", "status", "address", "customer_id")
+        if args[name] is not None
+    }
+    app.logger.info("Filtering by: %s", filters)
+    return filters
+
 
 ######################################################################
 #  PATH: /orders/{order_id}
@@ -161,7 +636,10 @@ class OrderResource(Resource):
     # ------------------------------------------------------------------
     @api.doc("get_orders")
     @api.response(404, "Order not found")
-    @api.marshal_with(order_model)
+    @api.response(304, "Not Modified")
+    @api.response(200, "Success", order_model)
+    @api.doc(__mask__=True)  # the X-Fields header, as marshal_with documents it
+    @api.expect(order_get_args, validate=True)
     def get(self, order_id):
         """
         Retrieve a single order
@@ -169,15 +647,23 @@ class OrderResource(Resource):
         This endpoint will return an order based on its id
         """
         app.logger.info("Request for order with id: %s", order_id)
-        # See if the order exists and abort if it doesn't
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"order with id '{order_id}' could not be found.",
-            )
-
-        return order.serialize(), status.HTTP_200_OK
+        args = order_get_args.parse_args()
+        selected, model = order_fields(args)
+
+        def render():
+            # See if the order exists and abort if it doesn't
+            order = Order.find(order_id)
+            if not order:
+                abort(
+                    status.HTTP_404_NOT_FOUND,
+                    f"order with id '{order_id}' could not be found.",
+                )
+            data = marshal_fields(order, model, selected)
+            return data, order.version
+
+        return cached_response(
+            Order.cache_key(order_id), fields_variant(selected), render
+        )
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ORDER
@@ -185,6 +671,7 @@ class OrderResource(Resource):
     @api.doc("update_orders")
     @api.response(404, "Order not found")
     @api.response(400, "The posted Order data was not valid")
+    @api.response(412, "The Order has changed since the ETag in If-Match")
     @api.expect(order_model)
     @api.marshal_with(order_model)
     def put(self, order_id):
@@ -194,26 +681,28 @@ class OrderResource(Resource):
         This endpoint will update an Order based the body that is posted
         """
         app.logger.info("Request to Update an order with id [%s]", order_id)
-        check_content_type("application/json")
+        check_content_type(*BODY_TYPES)
         # Attempt to find the Order and abort if not found
         order = Order.find(order_id)
         if not order:
             abort(
                 status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
             )
-        app.logger.debug("Payload = %s", api.payload)
-        data = api.payload
+        check_if_match(order.version)
+        app.logger.debug("Payload = %s", payload())
+        data = payload()
         order.deserialize(data)
         order.id = order_id
         order.update()
         app.logger.info("Order with ID: %d updated.", order.id)
-        return order.serialize(), status.HTTP_200_OK
+        return order.serialize(), status.HTTP_200_OK, version_etag(order.version)
 
     # ------------------------------------------------------------------
     # DELETE AN ORDER
     # ------------------------------------------------------------------
     @api.doc("delete_orders")
     @api.response(204, "Order deleted")
+    @api.response(412, "The Order has changed since the ETag in If-Match")
     def delete(self, order_id):
         """
         Delete an Order
@@ -225,6 +714,7 @@ class OrderResource(Resource):
         order = Order.find(order_id)
         if order:
             app.logger.info("Order with ID: %d found.", order.id)
+            check_if_match(order.version)
             order.delete()
             app.logger.info("Order with ID: %d delete complete.", order_id)
         return "", status.HTTP_204_NO_CONTENT
@@ -242,70 +732,178 @@ class OrderCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_orders")
     @api.response(400, "The query data was not valid")
+    @api.response(304, "Not Modified")
+    @api.response(200, "Success", [order_model])
+    @api.doc(__mask__=True)  # the X-Fields header, as marshal_with documents it
     @api.expect(order_args, validate=True)
-    @api.marshal_list_with(order_model)
+    @compressed
     def get(self):
         """
         Retrieve all orders
         """
         app.logger.info("Request to Retrieve All Orders")
-        orders = []
         args = order_args.parse_args()
         app.logger.info(f"Parsed arguments: {args}")
 
-        if args["date"]:
-            app.logger.info("Filtering by date: %s", args["date"])
-            # date_obj = datetime.strptime(args["date"], "%Y-%m-%d").date()
-            # orders = Order.find_by_date(date_obj)
-            orders = Order.find_by_date(args["date"])
-        elif args["status"]:
-            app.logger.info("Filtering by status: %s", args["status"])
-            # status_obj = int(args["status"])
-            orders = Order.find_by_status(args["status"])
-        elif args["address"]:
-            app.logger.info("Filtering by address: %s", args["address"])
-            orders = Order.find_by_address(args["address"])
-        elif args["customer_id"]:
-            app.logger.info("Filtering by customer id: %s", args["customer_id"])
-            # customer_id = int(args["customer_id"])
-            orders = Order.find_by_customer_id(args["customer_id"])
-        else:
-            app.logger.info("Returning unfiltered list.")
-            orders = Order.all()
-
-        orders = sorted(
-            orders,
-            key=lambda order: order.date,
-            reverse=True,
-        )
+        filters = order_filters(args)
+        selected, model = order_fields(args)
+        # a client that has the page already is told so before it is read
+        etag = list_etag(Order.page_tag(filters, args["limit"], args["cursor"]))
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        # rows are only serialized, so they are read without building Orders
+        orders = Order.page_rows(filters, args["limit"], args["cursor"], selected)
         app.logger.info("[%s] Orders returned", len(orders))
-        results = [order.serialize() for order in orders]
-        return results, status.HTTP_200_OK
+        # the rows are marshalled as they are unless Items are embedded in them
+        results = Order.serialize_rows(orders, selected) if args["expand"] else orders
+
+        # A full page means there may be more, so tell the client where
+        headers = {}
+        if len(orders) == args["limit"]:
+            query = request.args.to_dict()
+            query["cursor"] = encode_cursor(orders[-1])
+            next_url = api.url_for(OrderCollection, _external=True, **query)
+            headers["Link"] = f'<{next_url}>; rel="next"'
+
+        results = marshal_fields(results, model, selected)
+        response = api.make_response(results, status.HTTP_200_OK, headers)
+        response.set_etag(etag)
+        response.vary.update(("Accept", app.config["RESTX_MASK_HEADER"]))
+        return response
 
     # ------------------------------------------------------------------
     # ADD A NEW ORDER
     # ------------------------------------------------------------------
     @api.doc("create_orders")
     @api.response(400, "The posted order data was not valid")
-    @api.response(415, "Content-Type must be application/json")
-    @api.expect(create_model)
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
+    @api.expect(create_items_model)
+    @idempotent
     @api.marshal_with(order_model, code=201)
     def post(self):
         """
         Create an Order
-        This endpoint will create an Order based the data in the body that is posted
+        This endpoint will create an Order based the data in the body that is posted,
+        together with any items it lists
         """
         app.logger.info("Request to Create an Order...")
-        check_content_type("application/json")
+        check_content_type(*BODY_TYPES)
         order = Order()
-        app.logger.debug("Payload = %s", api.payload)
-        order.deserialize(api.payload)
+        app.logger.debug("Payload = %s", payload())
+        data = payload()
+        if isinstance(data, dict) and "items" in data:
+            # the amount can be left out, as create() makes it the Items' total
+            order.deserialize({"amount": 0, **data})
+            order.items = item_lines(data["items"])
+        else:
+            order.deserialize(data)
         order.create()
         app.logger.info("Order with new id [%s] saved!", order.id)
         location_url = api.url_for(OrderResource, order_id=order.id, _external=True)
         return order.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /orders/export
+######################################################################
+@api.route("/orders/export")
+class OrderExport(Resource):
+    """Streams every Order as newline-delimited JSON"""
+
+    # ------------------------------------------------------------------
+    # EXPORT ALL ORDERS
+    # ------------------------------------------------------------------
+    @api.doc("export_orders")
+    @api.response(400, "The query data was not valid")
+    @api.produces(["application/x-ndjson"])
+    @api.expect(export_args, validate=True)
+    @compressed
+    def get(self):
+        """
+        Export all orders
+
+        This endpoint streams one Order per line, newest first, without
+        holding the whole result in memory
+        """
+        app.logger.info("Request to Export All Orders")
+        args = export_args.parse_args()
+        filters = order_filters(args)
+
+        def generate():
+            for order in Order.stream(filters):
+                yield json.dumps(order.serialize()) + "\n"
+
+        return Response(
+            stream_with_context(generate()), mimetype="application/x-ndjson"
+        )
+
+
+######################################################################
+#  PATH: /orders/batch
+######################################################################
+MAX_BATCH_SIZE = 10000
+
+
+@api.route("/orders/batch")
+class OrderBatch(Resource):
+    """Creates many Orders at once"""
+
+    # ------------------------------------------------------------------
+    # ADD MANY NEW ORDERS
+    # ------------------------------------------------------------------
+    @api.doc("create_order_batch")
+    @api.response(201, "Every order was created", [batch_result_model])
+    @api.response(207, "Some orders were not valid", [batch_result_model])
+    @api.response(400, "The posted data was not a list of orders")
+    @api.response(413, f"More than {MAX_BATCH_SIZE} orders were posted")
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
+    @api.expect([create_model])
+    @idempotent
+    def post(self):
+        """
+        Create many Orders
+
+        This endpoint validates every Order in the list that is posted and
+        creates the valid ones in one transaction. The result of each Order
+        is returned in the position it was posted in.
+        """
+        app.logger.info("Request to Create a batch of Orders...")
+        check_content_type(*BODY_TYPES)
+        data = payload()
+        if not isinstance(data, list) or not data:
+            abort(status.HTTP_400_BAD_REQUEST, "Request body must be a list of orders")
+        if len(data) > MAX_BATCH_SIZE:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                f"At most {MAX_BATCH_SIZE} orders can be created at once",
+            )
+        orders = []
+        results = []
+        for order_data in data:
+            try:
+                # values that would fail the INSERT fail only their own Order
+                orders.append(Order().deserialize(order_data).check_columns())
+                results.append(None)
+            except DataValidationError as error:
+                results.append(
+                    {"status": status.HTTP_400_BAD_REQUEST, "error": str(error)}
+                )
+        Order.create_all(orders)
+        app.logger.info("Created %d of %d Orders", len(orders), len(data))
+        created = iter(orders)
+        results = [
+            result or {"status": status.HTTP_201_CREATED, "id": next(created).id}
+            for result in results
+        ]
+        code = (
+            status.HTTP_201_CREATED
+            if len(orders) == len(data)
+            else status.HTTP_207_MULTI_STATUS
+        )
+        return results, code
+
+
 ######################################################################
 #  PATH: /orders/{id}/cancel
 ######################################################################
@@ -317,6 +915,7 @@ class CancelResource(Resource):
     @api.doc("cancel_orders")
     @api.response(404, "Order not found")
     @api.response(409, "The Order is not available for cancel")
+    @api.response(412, "The Order has changed since the ETag in If-Match")
     def put(self, order_id):
         """Cancel an order"""
         app.logger.info("Request to cancel order with id: %d", order_id)
@@ -327,6 +926,7 @@ class CancelResource(Resource):
             abort(
                 status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found."
             )
+        check_if_match(order.version)
         # you can only cancel orders that are available
         if order.status == 0:
             abort(
@@ -338,7 +938,128 @@ class CancelResource(Resource):
         order.status = 0
         order.update()
         app.logger.info("Order with ID: %d has been cancelled.", order_id)
-        return order.serialize(), status.HTTP_200_OK
+        return order.serialize(), status.HTTP_200_OK, version_etag(order.version)
+
+
+# the Orders chosen by id for a bulk status change, and the new status
+transition_model = api.model(
+    "OrderTransition",
+    {
+        "ids": fields.List(
+            fields.Integer, description="The ids of the orders to change"
+        ),
+        "status": fields.Integer(description="The status to move the orders to"),
+    },
+)
+
+# the Orders that a bulk status change moved
+transition_result_model = api.model(
+    "OrderTransitionResult",
+    {
+        "ids": fields.List(
+            fields.Integer, description="The ids of the orders that were moved"
+        ),
+    },
+)
+
+
+def valid_ids(value):
+    """
+    Checks that value is a list of Order ids.
+    Raises a DataValidationError if it is not.
+    """
+    if not isinstance(value, list) or not all(
+        isinstance(order_id, int) and not isinstance(order_id, bool)
+        for order_id in value
+    ):
+        raise DataValidationError("Invalid ids: must be a list of order ids")
+    return value
+
+
+def transition_orders(new_status, data):
+    """
+    Moves the Orders chosen by the request to a new status
+
+    The Orders are the ones whose ids are listed in data, matching the
+    query string filters, and both when both are given.
+    """
+    filters = order_filters(transition_args.parse_args())
+    ids = data.get("ids")
+    if ids is None and not filters:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "Orders must be chosen by a list of ids or a query",
+        )
+    if ids is not None:
+        valid_ids(ids)
+    moved_ids = Order.transition(new_status, ids, **filters)
+    app.logger.info("Moved %d Orders to status %s", len(moved_ids), new_status)
+    return {"ids": moved_ids}, status.HTTP_200_OK
+
+
+def request_object():
+    """Returns the JSON object in the body of the request, or {} if there is none"""
+    if not request.content_length:
+        return {}
+    check_content_type(*BODY_TYPES)
+    data = payload()
+    if not isinstance(data, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be an object")
+    return data
+
+
+######################################################################
+#  PATH: /orders/cancel
+######################################################################
+@api.route("/orders/cancel")
+class CancelCollection(Resource):
+    """Cancels many Orders at once"""
+
+    @api.doc("cancel_order_batch")
+    @api.response(400, "No Orders were chosen, or the ids were not valid")
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
+    @api.expect(transition_args, transition_model)
+    @api.marshal_with(transition_result_model)
+    def put(self):
+        """
+        Cancel many Orders
+
+        This endpoint cancels the Orders with the ids in the body and/or
+        matching the query, except the ones that are already cancelled
+        """
+        app.logger.info("Request to cancel a batch of Orders")
+        return transition_orders(CANCELLED, request_object())
+
+
+######################################################################
+#  PATH: /orders/status
+######################################################################
+@api.route("/orders/status")
+class StatusCollection(Resource):
+    """Moves many Orders to another status at once"""
+
+    @api.doc("transition_order_batch")
+    @api.response(400, "No Orders were chosen, or the ids or status were not valid")
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
+    @api.expect(transition_args, transition_model)
+    @api.marshal_with(transition_result_model)
+    def put(self):
+        """
+        Move many Orders to a status
+
+        This endpoint moves the Orders with the ids in the body and/or
+        matching the query to the status in the body, except the ones that
+        are cancelled
+        """
+        app.logger.info("Request to move a batch of Orders to another status")
+        data = request_object()
+        new_status = data.get("status")
+        if new_status not in ORDER_STATUSES or isinstance(new_status, bool):
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Invalid status: must be one of {list(ORDER_STATUSES)}",
+            )
+        return transition_orders(new_status, data)
 
 
 # ---------------------------------------------------------------------
@@ -363,6 +1084,23 @@ item_model = api.model(
     },
 )
 
+# an Order with its Items embedded, for ?expand=items
+order_items_model = api.inherit(
+    "OrderItemsModel",
+    order_model,
+    {
+        "items": fields.List(
+            fields.Nested(item_model), description="The items of the order"
+        ),
+    },
+)
+
+# The serializers of the models that responses are marshalled with, by name
+SERIALIZERS = {
+    model.name: Serializer(model)
+    for model in (order_model, order_items_model, item_model)
+}
+
 # query string arguments
 item_args = reqparse.RequestParser()
 item_args.add_argument(
@@ -371,6 +1109,60 @@ item_args.add_argument(
 item_args.add_argument(
     "quantity", type=int, location="args", required=False, help="List Items by quantity"
 )
+item_args.add_argument(
+    "fields",
+    type=field_list(list(item_model)),
+    location="args",
+    required=False,
+    help="Return only these comma separated fields of each Item",
+)
+
+
+######################################################################
+#  PATH: /orders/{order_id}/items/batch
+######################################################################
+@api.route("/orders/<int:order_id>/items/batch")
+@api.param("order_id", "The Order identifier")
+class ItemBatch(Resource):
+    """Adds or replaces many Items of an Order at once"""
+
+    # ------------------------------------------------------------------
+    # ADD OR REPLACE MANY ITEMS
+    # ------------------------------------------------------------------
+    @api.doc("upsert_item_batch")
+    @api.response(400, "The posted data was not valid")
+    @api.response(404, "Order not found")
+    @api.response(413, f"More than {MAX_BATCH_SIZE} items were posted")
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
+    @api.expect([item_line_model])
+    @idempotent
+    @api.marshal_list_with(item_model)
+    def post(self, order_id):
+        """
+        Add or replace many Items
+
+        This endpoint adds every Item in the list that is posted to the
+        Order, replacing the price and quantity of the ones it already has
+        """
+        app.logger.info("Request to Upsert a batch of Items for Order ID: %d", order_id)
+        check_content_type(*BODY_TYPES)
+        data = payload()
+        if not isinstance(data, list) or not data:
+            abort(status.HTTP_400_BAD_REQUEST, "Request body must be a list of items")
+        if len(data) > MAX_BATCH_SIZE:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                f"At most {MAX_BATCH_SIZE} items can be added at once",
+            )
+        if not Order.find(order_id):
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                f"Order with id '{order_id}' could not be found.",
+            )
+        items = item_lines(data, order_id)
+        Item.upsert_all(order_id, items)
+        app.logger.info("Upserted %d Items into Order %d", len(items), order_id)
+        return [item.serialize() for item in items], status.HTTP_200_OK
 
 
 ######################################################################
@@ -393,7 +1185,9 @@ class ItemResource(Resource):
     # ------------------------------------------------------------------
     @api.doc("get_items")
     @api.response(404, "Item not found")
-    @api.marshal_with(item_model)
+    @api.response(304, "Not Modified")
+    @api.response(200, "Success", item_model)
+    @api.doc(__mask__=True)  # the X-Fields header, as marshal_with documents it
     def get(self, order_id, product_id):
         """
         Get an Item
@@ -404,15 +1198,19 @@ class ItemResource(Resource):
             "Request to retrieve Item %s for Order id: %s", (product_id, order_id)
         )
 
-        # See if the item exists and abort if it doesn't
-        item = Item.find_by_product_id(order_id, product_id)
-        if not item:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"product with id '{product_id}' could not be found in order '{order_id}'.",
-            )
-
-        return item.serialize(), status.HTTP_200_OK
+        def render():
+            # See if the item exists and abort if it doesn't
+            item = Item.find_by_product_id(order_id, product_id)
+            if not item:
+                abort(
+                    status.HTTP_404_NOT_FOUND,
+                    f"product with id '{product_id}' could not be found in order '{order_id}'.",
+                )
+            return marshal_fields(item, item_model, None), item.version
+
+        return cached_response(
+            Item.cache_key(order_id, product_id), fields_variant(None), render
+        )
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ITEM
@@ -420,7 +1218,8 @@ class ItemResource(Resource):
     @api.doc("update_items")
     @api.response(400, "The posted Item data was not valid")
     @api.response(404, "Item not found")
-    @api.response(415, "Content-Type must be application/json")
+    @api.response(412, "The Item has changed since the ETag in If-Match")
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
     @api.expect(item_model)
     @api.marshal_with(item_model)
     def put(self, order_id, product_id):
@@ -431,7 +1230,7 @@ class ItemResource(Resource):
         app.logger.info(
             "Request to update Item %s for Order: %s", (product_id, order_id)
         )
-        check_content_type("application/json")
+        check_content_type(*BODY_TYPES)
         # See if the item exists and abort if it doesn't
         item = Item.find_by_product_id(order_id, product_id)
         if not item:
@@ -439,20 +1238,22 @@ class ItemResource(Resource):
                 status.HTTP_404_NOT_FOUND,
                 f"Item with id '{product_id}' could not be found in order '{order_id}'",
             )
+        check_if_match(item.version)
         # Update from the json in the body of the request
-        app.logger.debug("Payload = %s", api.payload)
-        data = api.payload
+        app.logger.debug("Payload = %s", payload())
+        data = payload()
         item.deserialize(data)
         # item.order_id = order_id
         # item.product_id = product_id
         item.update()
-        return item.serialize(), status.HTTP_200_OK
+        return item.serialize(), status.HTTP_200_OK, version_etag(item.version)
 
     # ------------------------------------------------------------------
     # DELETE AN ITEM
     # ------------------------------------------------------------------
     @api.doc("delete_items")
     @api.response(204, "Item deleted")
+    @api.response(412, "The Item has changed since the ETag in If-Match")
     def delete(self, order_id, product_id):
         """
         Delete an Item
@@ -467,6 +1268,7 @@ class ItemResource(Resource):
         # See if the item exists and delete it if it does
         item = Item.find_by_product_id(order_id, product_id)
         if item:
+            check_if_match(item.version)
             item.delete()
 
         return "", status.HTTP_204_NO_CONTENT
@@ -484,37 +1286,47 @@ class ItemCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_items")
     @api.response(404, "Order not found")
+    @api.response(304, "Not Modified")
+    @api.response(200, "Success", [item_model])
+    @api.doc(__mask__=True)  # the X-Fields header, as marshal_with documents it
     @api.expect(item_args, validate=True)
-    @api.marshal_list_with(item_model)
+    @compressed
     def get(self, order_id):
         """Returns all of the Items for an Order"""
         app.logger.info("Request for all Items for Order with id: %s", order_id)
-
-        # See if the order exists and abort if it doesn't
-        order = Order.find(order_id)
-        if not order:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Order with id '{order_id}' could not be found.",
-            )
-
-        items = []
         args = item_args.parse_args()
 
-        if args["price"]:
-            app.logger.info("Filtering by price: %s", args["price"])
-            # price = float(args["price"])
-            items = Item.find_by_price(order_id, args["price"])
-        elif args["quantity"]:
-            app.logger.info("Filtering by quantity: %s", args["quantity"])
-            # quantity = int(args["quantity"])
-            items = Item.find_by_quantity(order_id, args["quantity"])
-        else:
-            items = Item.find_by_order_id(order_id)
-        # Get the items for the order
-        app.logger.info("[%s] Items returned", len(items))
-        results = [item.serialize() for item in items]
-        return results, status.HTTP_200_OK
+        def render():
+            # See if the order exists and abort if it doesn't
+            order = Order.find(order_id)
+            if not order:
+                abort(
+                    status.HTTP_404_NOT_FOUND,
+                    f"Order with id '{order_id}' could not be found.",
+                )
+
+            filters = {}
+            if args["price"]:
+                app.logger.info("Filtering by price: %s", args["price"])
+                filters["price"] = args["price"]
+            elif args["quantity"]:
+                app.logger.info("Filtering by quantity: %s", args["quantity"])
+                filters["quantity"] = args["quantity"]
+            # Get the items for the order, serialized straight from the rows
+            results = Item.find_serialized([order_id], args["fields"], **filters)
+            app.logger.info("[%s] Items returned", len(results))
+            data = marshal_fields(results, item_model, args["fields"])
+            return data, order.version
+
+        # every change to the Items of an Order invalidates the Order and
+        # bumps its version
+        variant = (
+            "items",
+            args["price"],
+            args["quantity"],
+            fields_variant(args["fields"]),
+        )
+        return cached_response(Order.cache_key(order_id), variant, render)
 
     # ------------------------------------------------------------------
     # ADD A NEW ITEM
@@ -522,8 +1334,9 @@ class ItemCollection(Resource):
     @api.doc("create_items")
     @api.response(400, "The posted data was not valid")
     @api.response(404, "Order not found")
-    @api.response(415, "Content-Type must be application/json")
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
     @api.expect(item_model)
+    @idempotent
     @api.marshal_with(item_model, code=201)
     def post(self, order_id):
         """
@@ -531,7 +1344,7 @@ class ItemCollection(Resource):
         This endpoint will create an Item based on the data in the body that is posted
         """
         app.logger.info("Request to Create an Item for Order ID: %d", order_id)
-        check_content_type("application/json")
+        check_content_type(*BODY_TYPES)
 
         order = Order.find(order_id)
         if not order:
@@ -543,8 +1356,8 @@ class ItemCollection(Resource):
         # Get the order by order id
         item = Item()
         # Get the data from the request and deserialize it
-        app.logger.debug("Payload = %s", api.payload)
-        item.deserialize(api.payload)
+        app.logger.debug("Payload = %s", payload())
+        item.deserialize(payload())
         item.create()
 
         app.logger.info(
@@ -570,20 +1383,96 @@ def abort(error_code: int, message: str):
     api.abort(error_code, message)
 
 
-def check_content_type(content_type) -> None:
-    """Checks that the media type is correct"""
+def check_content_type(*content_types) -> None:
+    """Checks that the media type is one of the correct ones"""
+    expected = " or ".join(content_types)
     if "Content-Type" not in request.headers:
         app.logger.error("No Content-Type specified.")
         abort(
             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-            f"Content-Type must be {content_type}",
+            f"Content-Type must be {expected}",
         )
 
-    if request.headers["Content-Type"] == content_type:
+    if request.headers["Content-Type"] in content_types:
+        # the body must also be sent in an encoding it can be decoded from
+        request_encoding()
         return
 
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        f"Content-Type must be {content_type}",
+        f"Content-Type must be {expected}",
+    )
+
+
+def payload():
+    """Returns the body of the request, decoded from JSON or MessagePack"""
+    if request.mimetype != MSGPACK and request_encoding() == "identity":
+        return api.payload
+    # kept with the request, as g lasts as long as the app context does
+    if "service.payload" not in request.environ:
+        decode = msgpack.unpackb if request.mimetype == MSGPACK else json.loads
+        try:
+            request.environ["service.payload"] = decode(request_body())
+        except (ValueError, msgpack.UnpackException) as error:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Invalid {request.mimetype} body: {error}",
+            )
+    return request.environ["service.payload"]
+
+
+def request_encoding() -> str:
+    """Returns the Content-Encoding of the request body, or 415 if it is not
+    one that can be decoded"""
+    encoding = (request.content_encoding or "identity").strip().lower()
+    if encoding not in BODY_ENCODINGS:
+        app.logger.error("Invalid Content-Encoding: %s", encoding)
+        abort(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            f"Content-Encoding must be one of {', '.join(BODY_ENCODINGS)}",
+        )
+    return encoding
+
+
+def request_body() -> bytes:
+    """
+    Returns the body of the request, gunzipped if it was sent with
+    Content-Encoding: gzip
+
+    A body that would gunzip to more than MAX_DECOMPRESSED_SIZE bytes is
+    refused with 413 without being decompressed any further
+    """
+    if request_encoding() == "identity":
+        return request.get_data()
+    if "service.body" not in request.environ:
+        limit = app.config["MAX_DECOMPRESSED_SIZE"]
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        try:
+            body = decompressor.decompress(request.get_data(), limit + 1)
+        except zlib.error as error:
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid gzip body: {error}")
+        if len(body) > limit:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                f"The body must gunzip to at most {limit} bytes",
+            )
+        if not decompressor.eof:
+            abort(status.HTTP_400_BAD_REQUEST, "Invalid gzip body: it is truncated")
+        request.environ["service.body"] = body
+    return request.environ["service.body"]
+
+
+def check_if_match(version) -> None:
+    """Checks that the record has not changed since the ETag in If-Match"""
+    if not request.if_match or request.if_match.star_tag:
+        return
+    # the ETag of any variant of the record names the version it was read at
+    if str(version) in {etag_version(etag) for etag in request.if_match.as_set()}:
+        return
+
+    app.logger.error("If-Match %s is not version %s", request.if_match, version)
+    abort(
+        status.HTTP_412_PRECONDITION_FAILED,
+        f"The resource has changed since {request.if_match.to_header()}",
     )
@@ -216,17 +216,21 @@ $(function () {
         let customer_id = $("#order_customer_id").val();
         let date = $("#order_date").val();
 
-        let queryString = ""
+        let params = new URLSearchParams()
 
         if (status) {
-            queryString += 'status=' + status
-        }else if (address) {
-            queryString += 'address=' + address
-        }else if (date) {
-            queryString += 'date=' + date
-        }else if (customer_id) {
-            queryString += 'customer_id=' + customer_id
+            params.append('status', status)
+        }
+        if (address) {
+            params.append('address', address)
+        }
+        if (date) {
+            params.append('date', date)
+        }
+        if (customer_id) {
+            params.append('customer_id', customer_id)
         }
+        let queryString = params.toString()
 
         $("#flash_message").empty();
 
@@ -26,7 +26,12 @@ from click.testing import CliRunner
 
 # pylint: disable=unused-import
 from wsgi import app  # noqa: F401
-from service.common.cli_commands import db_create  # noqa: E402
+from service.common.cli_commands import (  # noqa: E402
+    db_create,
+    db_indexes,
+    db_columns,
+)
+from service.models import db  # noqa: E402
 
 
 class TestFlaskCLI(TestCase):
@@ -42,3 +47,49 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch("service.common.cli_commands.db")
+    def test_db_indexes(self, db_mock):
+        """It should call the db-indexes command"""
+        index_mock = MagicMock()
+        table_mock = MagicMock(indexes=[index_mock])
+        table_mock.name = "order"
+        table_mock.primary_key.columns = [MagicMock()]
+        table_mock.primary_key.columns[0].name = "id"
+        db_mock.metadata.sorted_tables = [table_mock]
+        inspector = db_mock.inspect.return_value
+        inspector.get_pk_constraint.return_value = {"constrained_columns": ["id"]}
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_indexes)
+            self.assertEqual(result.exit_code, 0)
+        index_mock.create.assert_called_once_with(db_mock.engine, checkfirst=True)
+        db_mock.engine.begin.assert_not_called()
+
+    def test_db_indexes_reorders_primary_key(self):
+        """It should move order_id to the front of an old item primary key"""
+        with app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(
+                    db.text(
+                        "ALTER TABLE item DROP CONSTRAINT item_pkey, "
+                        "ADD PRIMARY KEY (product_id, order_id)"
+                    )
+                )
+            with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+                result = self.runner.invoke(db_indexes)
+                self.assertEqual(result.exit_code, 0)
+            key = db.inspect(db.engine).get_pk_constraint("item")
+            self.assertEqual(key["constrained_columns"], ["order_id", "product_id"])
+
+    def test_db_columns_adds_missing_column(self):
+        """It should add the version column to an old item table"""
+        with app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(db.text("ALTER TABLE item DROP COLUMN version"))
+            with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+                result = self.runner.invoke(db_columns)
+                self.assertEqual(result.exit_code, 0)
+            columns = db.inspect(db.engine).get_columns("item")
+            version = [column for column in columns if column["name"] == "version"]
+            self.assertEqual(len(version), 1)
+            self.assertFalse(version[0]["nullable"])
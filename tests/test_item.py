@@ -24,8 +24,8 @@ import logging
 from unittest import TestCase
 from unittest.mock import patch
 from wsgi import app
-from service.models import Order, Item, db
-from service.models.persistent_base import DataValidationError
+from service.models import Order, Item, db, cache, responses
+from service.models.persistent_base import DataValidationError, VersionConflictError
 from .factories import OrderFactory, ItemFactory
 
 DATABASE_URI = os.getenv(
@@ -59,6 +59,9 @@ class TestItem(TestCase):
         db.session.query(Order).delete()  # clean up the last tests
         db.session.query(Item).delete()  # clean up the last tests
         db.session.commit()
+        # the deletes above bypass the invalidation of the caches
+        cache.clear()
+        responses.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -101,6 +104,103 @@ class TestItem(TestCase):
         self.assertEqual(new_order.id, new_item.order_id)
         self.assertEqual(new_order.amount, item_amount + new_item_amount)
 
+    def test_create_item_in_one_statement(self):
+        """It should insert an Item and add to its Order's amount in one statement"""
+        order = OrderFactory()
+        order.create()
+        # another writer has raised the amount behind this session's back
+        db.session.execute(
+            db.update(Order).where(Order.id == order.id).values(amount=10)
+        )
+        db.session.commit()
+        item = Item().deserialize(
+            {"order_id": order.id, "product_id": 1, "price": 2, "quantity": 3}
+        )
+        statements = []
+
+        def listener(*args):
+            # the cache invalidation sent on commit is not part of the write
+            if "pg_notify" not in args[2]:
+                statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            item.create()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(len(statements), 1)
+        order_id = item.order_id
+        db.session.expunge_all()
+        self.assertEqual(Order.find(order_id).amount, 16)
+        self.assertEqual(len(Item.find_by_order_id(order_id)), 1)
+
+    def test_upsert_all_items(self):
+        """It should add and replace many Items and recompute the amount once"""
+        order = OrderFactory()
+        order.create()
+        order_id = order.id
+        Item().deserialize(
+            {"order_id": order_id, "product_id": 1, "price": 5, "quantity": 1}
+        ).create()
+        items = [
+            Item().deserialize(
+                {"order_id": None, "product_id": product_id, "price": 2, "quantity": 3}
+            )
+            for product_id in (1, 2)
+        ]
+        statements = []
+
+        def listener(*args):
+            # the cache invalidation sent on commit is not part of the write
+            if "pg_notify" not in args[2]:
+                statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            Item.upsert_all(order_id, items)
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(len(statements), 2)
+        db.session.expunge_all()
+        self.assertEqual(Order.find(order_id).amount, 12)
+        found = Item.find_by_order_id(order_id)
+        self.assertEqual(sorted(item.quantity for item in found), [3, 3])
+
+    def test_upsert_all_repeated_product(self):
+        """It should not upsert a batch of Items with a repeated product"""
+        items = [ItemFactory(product_id=1), ItemFactory(product_id=1)]
+        self.assertRaises(DataValidationError, Item.upsert_all, 1, items)
+
+    def test_item_changes_drop_cached_order(self):
+        """It should not find a stale Order amount in the cache after its Items change"""
+        order = OrderFactory()
+        order.create()
+        order_id = order.id
+        item = Item().deserialize(
+            {"order_id": order_id, "product_id": 1, "price": 2, "quantity": 3}
+        )
+        self.assertEqual(Order.find(order_id).amount, 0)
+        item.create()
+        self.assertEqual(Order.find(order_id).amount, 6)
+        found = Item.find_by_product_id(order_id, 1)
+        found.quantity = 1
+        found.update()
+        self.assertEqual(Order.find(order_id).amount, 2)
+        self.assertEqual(Item.find_by_product_id(order_id, 1).quantity, 1)
+        Item.upsert_all(
+            order_id,
+            [
+                Item().deserialize(
+                    {"order_id": None, "product_id": 1, "price": 2, "quantity": 3}
+                )
+            ],
+        )
+        self.assertEqual(Order.find(order_id).amount, 6)
+        self.assertEqual(Item.find_by_product_id(order_id, 1).quantity, 3)
+        Item.find_by_product_id(order_id, 1).delete()
+        self.assertEqual(Order.find(order_id).amount, 0)
+        self.assertIsNone(Item.find_by_product_id(order_id, 1))
+
     def test_update_order_item(self):
         """It should Update an item in an order"""
         orders = Order.all()
@@ -135,6 +235,169 @@ class TestItem(TestCase):
         self.assertEqual(found_item.quantity, item_quantity + 10)
         self.assertEqual(found_order.amount, new_order_amount)
 
+    def test_update_item_in_one_statement(self):
+        """It should update an Item and its Order's amount without loading the Order"""
+        order = OrderFactory()
+        order.create()
+        for _ in range(3):
+            ItemFactory(order=order).create()
+        item = Item().deserialize(
+            {"order_id": order.id, "product_id": 100, "price": 2, "quantity": 3}
+        )
+        item.create()
+        order_id = item.order_id
+        db.session.expunge_all()
+        amount = Order.find(order_id).amount
+        # another writer has raised the amount behind this session's back
+        db.session.execute(
+            db.update(Order)
+            .where(Order.id == order_id)
+            .values(amount=Order.amount + 10)
+        )
+        db.session.commit()
+        item = Item.find_by_product_id(order_id, 100)
+        item.quantity = 5
+        statements = []
+
+        def listener(*args):
+            # the cache invalidation sent on commit is not part of the write
+            if "pg_notify" not in args[2]:
+                statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            item.update()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(Order.find(order_id).amount, amount + 10 + 4)
+        self.assertEqual(Item.find_by_product_id(order_id, 100).quantity, 5)
+
+    def test_move_item_to_another_order(self):
+        """It should move an Item's amount when it is updated into another Order"""
+        orders = OrderFactory.create_batch(2)
+        for order in orders:
+            order.create()
+        source, target = [order.id for order in orders]
+        item = Item().deserialize(
+            {"order_id": source, "product_id": 1, "price": 2, "quantity": 3}
+        )
+        item.create()
+        item.order_id = target
+        item.update()
+        self.assertEqual(Order.find(source).amount, 0)
+        self.assertEqual(Order.find(target).amount, 6)
+        self.assertIsNone(Item.find_by_product_id(source, 1))
+        self.assertEqual(Item.find_by_product_id(target, 1).quantity, 3)
+
+    def test_find_serialized(self):
+        """It should read Items serialized without building them"""
+        order = OrderFactory()
+        order.create()
+        for item in ItemFactory.create_batch(3, order=order, quantity=2):
+            item.create()
+        ItemFactory(order=order, quantity=4).create()
+        expected = [item.serialize() for item in Item.find_by_order_id(order.id)]
+        db.session.expunge_all()
+        found = Item.find_serialized([order.id])
+        self.assertEqual(sorted(found, key=lambda item: item["product_id"]), expected)
+        self.assertEqual(len(db.session.identity_map), 0)
+        self.assertEqual(len(Item.find_serialized([order.id], quantity=2)), 3)
+        found = Item.find_serialized([order.id], ["product_id"], quantity=4)
+        self.assertEqual(list(found[0]), ["product_id"])
+
+    def test_write_item_without_select(self):
+        """It should write an Item and serialize it without reading it or its Order"""
+        order = OrderFactory()
+        order.create()
+        item = Item().deserialize(
+            {"order_id": order.id, "product_id": 1, "price": 2, "quantity": 3}
+        )
+        statements = []
+
+        def listener(*args):
+            if args[2].lstrip().upper().startswith("SELECT"):
+                statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            item.create()
+            created = item.serialize()
+            item.quantity = 5
+            item.update()
+            updated = item.serialize()
+            item.delete()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        # only the cache invalidations sent on commit are SELECTs
+        self.assertTrue(all("pg_notify" in sql for sql in statements))
+        self.assertEqual(created["quantity"], 3)
+        self.assertEqual(updated["quantity"], 5)
+        self.assertEqual(Order.find(order.id).amount, 0)
+
+    def test_update_missing_item(self):
+        """It should not update an Item that is not in the database"""
+        order = OrderFactory()
+        order.create()
+        item = Item().deserialize(
+            {"order_id": order.id, "product_id": 1, "price": 2, "quantity": 3}
+        )
+        self.assertRaises(DataValidationError, item.update)
+        self.assertEqual(Order.find(order.id).amount, 0)
+
+    def test_item_writes_bump_versions(self):
+        """It should give an Item and its Order a new version on every write"""
+        order = OrderFactory()
+        order.create()
+        order_id = order.id
+        item = ItemFactory(order=order)
+        item.create()
+        self.assertEqual(item.version, 1)
+        self.assertEqual(Order.find(order_id).version, 2)
+        item.quantity += 1
+        item.update()
+        self.assertEqual(item.version, 2)
+        self.assertEqual(Order.find(order_id).version, 3)
+        product_id = item.product_id
+        Item.upsert_all(order_id, [ItemFactory(product_id=product_id)])
+        db.session.expunge_all()
+        self.assertEqual(Item.find_by_product_id(order_id, product_id).version, 3)
+        self.assertEqual(Order.find(order_id).version, 4)
+        # an Item worth nothing still changes its Order when it goes
+        item = ItemFactory(order=Order.find(order_id), price=0)
+        item.create()
+        item.delete()
+        self.assertEqual(Order.find(order_id).version, 6)
+
+    def test_update_changed_item(self):
+        """It should not update or delete an Item someone else changed first"""
+        order = OrderFactory()
+        order.create()
+        order_id = order.id
+        item = ItemFactory(order=order)
+        item.create()
+        item = Item.find_by_product_id(order_id, item.product_id)
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.update(Item)
+                .where(Item.order_id == order_id)
+                .values(version=Item.version + 1)
+            )
+        item.quantity += 1
+        self.assertRaises(VersionConflictError, item.update)
+        self.assertEqual(Order.find(order_id).amount, item.amount())
+        item = Item.find_by_product_id(order_id, item.product_id)
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.update(Item)
+                .where(Item.order_id == order_id)
+                .values(version=Item.version + 1)
+            )
+        product_id = item.product_id
+        self.assertRaises(VersionConflictError, item.delete)
+        db.session.expunge_all()
+        self.assertIsNotNone(Item.find_by_product_id(order_id, product_id))
+
     def test_delete_order_item(self):
         """It should Delete an item of an order"""
         orders = Order.all()
@@ -181,11 +444,17 @@ class TestItem(TestCase):
         self.assertEqual(serial_item["quantity"], item.quantity)
         self.assertEqual(serial_item["price"], item.price)
 
+    def test_serialize_item_fields(self):
+        """It should serialize only some fields of an Item"""
+        item = ItemFactory()
+        serial_item = item.serialize(["product_id"])
+        self.assertEqual(serial_item, {"product_id": item.product_id})
+
     def test_deserialize_an_item(self):
         """It should deserialize an Item"""
         order = OrderFactory()
-        item = ItemFactory(order=order)
         order.create()
+        item = ItemFactory(order=order)
         item.create()
         new_item = Item()
         new_item.deserialize(item.serialize())
@@ -246,6 +515,11 @@ class TestItem(TestCase):
         self.assertEqual(found_item.price, item.price)
         self.assertEqual(found_item.quantity, item.quantity)
 
+    def test_primary_key_leads_with_order_id(self):
+        """It should key Items on order_id first so finders can seek on it"""
+        key = db.inspect(db.engine).get_pk_constraint("item")
+        self.assertEqual(key["constrained_columns"], ["order_id", "product_id"])
+
     ######################################################################
     #  T E S T   F A I L S
     ######################################################################
@@ -257,6 +531,13 @@ class TestItem(TestCase):
         item = ItemFactory()
         self.assertRaises(DataValidationError, item.create)
 
+    @patch("service.models.db.session.commit")
+    def test_upsert_all_items_failed(self, exception_mock):
+        """It should not upsert items on database error"""
+        exception_mock.side_effect = Exception()
+        item = ItemFactory()
+        self.assertRaises(DataValidationError, Item.upsert_all, item.order_id, [item])
+
     @patch("service.models.db.session.commit")
     def test_update_item_failed(self, exception_mock):
         """It should not update an item on database error"""
@@ -271,6 +552,20 @@ class TestItem(TestCase):
         item = ItemFactory()
         self.assertRaises(DataValidationError, item.delete)
 
+    def test_delete_item_failed_keeps_order_amount(self):
+        """It should leave the amount of the Order when deleting an item fails"""
+        order = OrderFactory()
+        order.create()
+        item = ItemFactory(order=order)
+        item.create()
+        order_id, product_id = order.id, item.product_id
+        amount = Order.find(order_id).amount
+        with patch("service.models.db.session.commit", side_effect=Exception()):
+            self.assertRaises(DataValidationError, item.delete)
+        db.session.expunge_all()
+        self.assertEqual(Order.find(order_id).amount, amount)
+        self.assertIsNotNone(Item.find_by_product_id(order_id, product_id))
+
     def test_update_item_without_order_id(self):
         """It should not update an item without order id"""
         item = ItemFactory()
@@ -25,8 +25,8 @@ import logging
 from unittest import TestCase
 from unittest.mock import patch
 from wsgi import app
-from service.models import Order, Item, db
-from service.models.persistent_base import DataValidationError
+from service.models import Order, Item, db, cache, responses
+from service.models.persistent_base import DataValidationError, VersionConflictError
 from .factories import OrderFactory, ItemFactory
 
 DATABASE_URI = os.getenv(
@@ -59,6 +59,9 @@ class TestOrder(TestCase):
         """This runs before each test"""
         db.session.query(Order).delete()  # clean up the last tests
         db.session.commit()
+        # the deletes above bypass the invalidation of the caches
+        cache.clear()
+        responses.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -150,6 +153,55 @@ class TestOrder(TestCase):
         orders = Order.all()
         self.assertEqual(len(orders), 1)
 
+    def test_create_order_with_items(self):
+        """It should Create an order with its items and their total as amount"""
+        order = OrderFactory()
+        order.items = [
+            Item().deserialize(
+                {"order_id": None, "product_id": product_id, "price": 2, "quantity": 3}
+            )
+            for product_id in (1, 2)
+        ]
+        order.create()
+        order_id = order.id
+        db.session.expunge_all()
+        self.assertEqual(Order.find(order_id).amount, 12)
+        self.assertEqual(len(Item.find_by_order_id(order_id)), 2)
+
+    def test_create_order_with_bad_items(self):
+        """It should not Create an order with items that are not numbers"""
+        order = OrderFactory()
+        order.items = [
+            Item().deserialize(
+                {"order_id": None, "product_id": 1, "price": "two", "quantity": None}
+            )
+        ]
+        self.assertRaises(DataValidationError, order.create)
+        db.session.rollback()
+        self.assertEqual(Order.all(), [])
+
+    def test_create_all_orders(self):
+        """It should Create many orders with one statement"""
+        orders = OrderFactory.create_batch(3)
+        statements = []
+
+        def listener(*args):
+            # the cache invalidation sent on commit is not part of the write
+            if "pg_notify" not in args[2]:
+                statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            Order.create_all(orders)
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(len(statements), 1)
+        for order in orders:
+            self.assertEqual(Order.find(order.id).address, order.address)
+        self.assertEqual(len(Order.all()), 3)
+        Order.create_all([])
+        self.assertEqual(len(Order.all()), 3)
+
     def test_delete_an_order(self):
         """It should Delete an order from the database"""
         orders = Order.all()
@@ -187,6 +239,67 @@ class TestOrder(TestCase):
         self.assertEqual(serial_order["address"], order.address)
         self.assertEqual(serial_order["customer_id"], order.customer_id)
 
+    def test_serialize_order_fields(self):
+        """It should Serialize only some fields of an order"""
+        order = OrderFactory()
+        serial_order = order.serialize(["id", "status"])
+        self.assertEqual(serial_order, {"id": order.id, "status": order.status})
+
+    def test_page_rows_fields(self):
+        """It should read only the columns asked for, and the cursor key"""
+        OrderFactory().create()
+        row = Order.page_rows({}, fields=["status"])[0]
+        self.assertEqual(set(row._fields), {"id", "date", "status"})
+
+    def test_page_rows(self):
+        """It should serialize a page of rows as it serializes the same Orders"""
+        for order in OrderFactory.create_batch(3):
+            order.create()
+            ItemFactory(order=order).create()
+        db.session.expunge_all()
+        expected = [
+            order.serialize(["id", "amount", "items"])
+            for order in Order.query_by().limit(2)
+        ]
+        db.session.expunge_all()
+        statements = []
+
+        def listener(*args):
+            statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            rows = Order.page_rows({}, limit=2, fields=["id", "amount", "items"])
+            serialized = Order.serialize_rows(rows, ["id", "amount", "items"])
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(serialized, expected)
+        # nothing read for the listing is put in the session
+        self.assertEqual(len(db.session.identity_map), 0)
+        after = (rows[-1].date, rows[-1].id)
+        self.assertEqual(len(Order.page_rows({}, after=after)), 1)
+        first = Order.query_by().first()
+        rows = Order.page_rows({}, limit=1)
+        self.assertEqual(Order.serialize_rows(rows), [first.serialize()])
+
+    def test_page_tag_swapped_orders(self):
+        """It should tag a page by its Orders, not by totals that other Orders match"""
+        orders = OrderFactory.create_batch(4, status=2)
+        for order in orders:
+            order.create()
+        ids = [order.id for order in orders]
+        self.assertEqual(ids, list(range(ids[0], ids[0] + 4)))
+        # the first and last Orders are on the page, at version 2
+        Order.transition(1, [ids[0], ids[3]])
+        tag = Order.page_tag({"status": 1})
+        self.assertEqual(Order.page_tag({"status": 1}), tag)
+        # the middle two take their place, at version 2, with the same id total
+        Order.transition(3, [ids[0], ids[3]])
+        Order.transition(1, [ids[1], ids[2]])
+        self.assertNotEqual(Order.page_tag({"status": 1}), tag)
+        self.assertEqual(Order.page_tag({"status": 0}), "")
+
     def test_deserialize_an_order(self):
         """It should deserialize an Order"""
         order = OrderFactory()
@@ -208,7 +321,7 @@ class TestOrder(TestCase):
         order = OrderFactory()
         order.create()
         # Read it back
-        found_order = Order.find_by_date(order.date)[0]
+        found_order = Order.query_by(date=order.date).all()[0]
         self.assertEqual(found_order.id, order.id)
         self.assertEqual(found_order.date, order.date)
         self.assertEqual(found_order.status, order.status)
@@ -221,7 +334,7 @@ class TestOrder(TestCase):
         order = OrderFactory()
         order.create()
         # Read it back
-        found_order = Order.find_by_address(order.address)[0]
+        found_order = Order.query_by(address=order.address).all()[0]
         self.assertEqual(found_order.id, order.id)
         self.assertEqual(found_order.date, order.date)
         self.assertEqual(found_order.status, order.status)
@@ -234,7 +347,7 @@ class TestOrder(TestCase):
         order = OrderFactory()
         order.create()
         # Read it back
-        found_order = Order.find_by_customer_id(order.customer_id)[0]
+        found_order = Order.query_by(customer_id=order.customer_id).all()[0]
         self.assertEqual(found_order.id, order.id)
         self.assertEqual(found_order.date, order.date)
         self.assertEqual(found_order.status, order.status)
@@ -247,7 +360,7 @@ class TestOrder(TestCase):
         order = OrderFactory()
         order.create()
         # Read it back
-        found_order = Order.find_by_status(order.status)[0]
+        found_order = Order.query_by(status=order.status).all()[0]
         self.assertEqual(found_order.id, order.id)
         self.assertEqual(found_order.date, order.date)
         self.assertEqual(found_order.status, order.status)
@@ -260,7 +373,7 @@ class TestOrder(TestCase):
         order = OrderFactory()
         order.create()
         # Read it back
-        found_order = Order.find_by_amount(order.amount)[0]
+        found_order = Order.query_by(amount=order.amount).all()[0]
         self.assertEqual(found_order.id, order.id)
         self.assertEqual(found_order.date, order.date)
         self.assertEqual(found_order.status, order.status)
@@ -268,6 +381,220 @@ class TestOrder(TestCase):
         self.assertEqual(found_order.address, order.address)
         self.assertEqual(found_order.customer_id, order.customer_id)
 
+    def test_page_rows_after(self):
+        """It should read a page of orders after a (date, id) key"""
+        for order in OrderFactory.create_batch(5):
+            order.create()
+        everything = [(row.date, row.id) for row in Order.page_rows({})]
+        self.assertEqual(len(everything), 5)
+        self.assertEqual(everything, sorted(everything, reverse=True))
+        first = [(row.date, row.id) for row in Order.page_rows({}, limit=2)]
+        self.assertEqual(first, everything[:2])
+        rest = Order.page_rows({}, limit=10, after=first[-1])
+        self.assertEqual([(row.date, row.id) for row in rest], everything[2:])
+
+    def test_query_by_many_filters(self):
+        """It should query orders matching every filter given"""
+        for order in OrderFactory.create_batch(2, customer_id=5, status=1):
+            order.create()
+        OrderFactory(customer_id=5, status=2).create()
+        OrderFactory(customer_id=6, status=1).create()
+        orders = Order.query_by(customer_id=5, status=1).all()
+        self.assertEqual(len(orders), 2)
+        for order in orders:
+            self.assertEqual(order.customer_id, 5)
+            self.assertEqual(order.status, 1)
+
+    def test_stream_orders(self):
+        """It should stream every order in batches"""
+        for order in OrderFactory.create_batch(5):
+            order.create()
+        orders = list(Order.stream({}, batch_size=2))
+        self.assertEqual(orders, Order.query_by().all())
+
+    def test_transition_orders(self):
+        """It should move the chosen Orders that are not cancelled in one statement"""
+        orders = OrderFactory.create_batch(4, status=1, customer_id=7)
+        orders[1].status = 0
+        orders[2].customer_id = 8
+        for order in orders:
+            order.create()
+        ids = [order.id for order in orders]
+        statements = []
+
+        def listener(*args):
+            # the cache invalidation sent on commit is not part of the write
+            if "pg_notify" not in args[2]:
+                statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            moved = Order.transition(0, ids[:3], customer_id=7)
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(moved, [ids[0]])
+        self.assertEqual(Order.transition(2, customer_id=7), [ids[3]])
+        self.assertEqual(Order.transition(2, customer_id=7), [])
+        statuses = {order.id: order.status for order in Order.all()}
+        self.assertEqual(statuses, dict(zip(ids, [0, 0, 1, 2])))
+
+    def test_transition_without_choice(self):
+        """It should not move every Order when none are chosen"""
+        self.assertRaises(DataValidationError, Order.transition, 0)
+        self.assertRaises(DataValidationError, Order.transition, 0, [1], name="x")
+
+    def test_find_from_cache(self):
+        """It should find an Order again without a query until it changes"""
+        order = OrderFactory()
+        order.create()
+        order_id = order.id
+        db.session.expunge_all()
+        Order.find(order_id)
+        db.session.expunge_all()
+        statements = []
+
+        def listener(*args):
+            # the cache invalidation sent on commit is not part of the write
+            if "pg_notify" not in args[2]:
+                statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            found = Order.find(order_id)
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(statements, [])
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(found.address, order.address)
+        # a cached Order can be changed like any other
+        found.address = "new address"
+        found.update()
+        self.assertEqual(Order.find(order_id).address, "new address")
+        Order.transition(0, [order_id])
+        self.assertEqual(Order.find(order_id).status, 0)
+        Order.find(order_id).delete()
+        self.assertIsNone(Order.find(order_id))
+
+    def test_delete_order_drops_cached_items(self):
+        """It should not find the Items of a deleted Order in the cache"""
+        order = OrderFactory()
+        order.create()
+        item = ItemFactory(order=order)
+        item.create()
+        order_id, product_id = item.order_id, item.product_id
+        self.assertIsNotNone(Item.find_by_product_id(order_id, product_id))
+        Order.find(order_id).delete()
+        self.assertIsNone(Item.find_by_product_id(order_id, product_id))
+
+    def test_rollback_keeps_cached_order(self):
+        """It should not drop an Order from the cache for a write that was rolled back"""
+        order = OrderFactory()
+        order.create()
+        order_id = order.id
+        db.session.expunge_all()
+        found = Order.find(order_id)
+        found.invalidate()
+        db.session.rollback()
+        db.session.commit()
+        db.session.expunge_all()
+        Order.find(order_id)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_order_writes_bump_version(self):
+        """It should give an Order a new version on every write"""
+        order = OrderFactory(status=1)
+        order.create()
+        self.assertEqual(order.version, 1)
+        order.address = "somewhere else"
+        order.update()
+        self.assertEqual(order.version, 2)
+        Order.transition(2, [order.id])
+        self.assertEqual(Order.find(order.id).version, 3)
+        Order.update_amount(order.id, 10)
+        db.session.commit()
+        self.assertEqual(Order.find(order.id).version, 4)
+        orders = OrderFactory.create_batch(2)
+        Order.create_all(orders)
+        self.assertEqual([Order.find(o.id).version for o in orders], [1, 1])
+
+    def test_update_changed_order(self):
+        """It should not update or delete an Order someone else changed first"""
+        order = OrderFactory()
+        order.create()
+        order = Order.find(order.id)
+        with db.engine.begin() as connection:
+            connection.execute(db.update(Order).values(version=Order.version + 1))
+        order.address = "somewhere else"
+        self.assertRaises(VersionConflictError, order.update)
+        order = Order.find(order.id)
+        with db.engine.begin() as connection:
+            connection.execute(db.update(Order).values(version=Order.version + 1))
+        self.assertRaises(VersionConflictError, order.delete)
+        self.assertEqual(len(Order.all()), 1)
+
+    def test_serialize_after_write_without_select(self):
+        """It should serialize a created or updated Order without reading it again"""
+        order = OrderFactory()
+        order.items = [
+            Item().deserialize(
+                {"order_id": None, "product_id": 1, "price": 2, "quantity": 3}
+            )
+        ]
+        statements = []
+
+        def listener(*args):
+            if args[2].lstrip().upper().startswith("SELECT"):
+                statements.append(args[2])
+
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            order.create()
+            created = order.serialize()
+            order.address = "somewhere else"
+            order.update()
+            updated = order.serialize()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        # only the cache invalidations sent on commit are SELECTs
+        self.assertTrue(all("pg_notify" in sql for sql in statements))
+        self.assertEqual(created["amount"], 6)
+        self.assertEqual(updated["address"], "somewhere else")
+        self.assertEqual(order.version, 2)
+
+    def test_query_by_bad_filter(self):
+        """It should not query orders by a column that does not exist"""
+        self.assertRaises(DataValidationError, Order.query_by, colour="red")
+
+    def test_query_is_newest_first(self):
+        """It should return query results newest first"""
+        for order in OrderFactory.create_batch(5, status=1):
+            order.create()
+        orders = Order.query_by(status=1).all()
+        self.assertEqual(len(orders), 5)
+        keys = [(order.date, order.id) for order in orders]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_query_uses_index(self):
+        """It should read filtered orders in date order from an index"""
+        # a fixed address, as a fake one can be too long for the column
+        orders = OrderFactory.create_batch(200, id=None, status=2, address="depot")
+        db.session.add_all(orders)
+        db.session.add(OrderFactory(id=None, status=1))
+        db.session.commit()
+        db.session.execute(db.text('ANALYZE "order"'))
+        # tiny test tables favour other plans, so only allow index scans
+        db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+        db.session.execute(db.text("SET LOCAL enable_bitmapscan = off"))
+        query = Order.query.filter(Order.status == 1).order_by(
+            Order.date.desc(), Order.id.desc()
+        )
+        sql = query.statement.compile(compile_kwargs={"literal_binds": True})
+        plan = db.session.execute(db.text(f"EXPLAIN {sql}")).scalars().all()
+        plan = "\n".join(plan)
+        self.assertIn("ix_order_status_date_id", plan)
+        self.assertNotIn("Sort", plan)
+
     ######################################################################
     #  T E S T   F A I L S
     ######################################################################
@@ -293,12 +620,48 @@ class TestOrder(TestCase):
         order = OrderFactory()
         self.assertRaises(DataValidationError, order.delete)
 
+    @patch("service.models.db.session.commit")
+    def test_create_all_orders_failed(self, exception_mock):
+        """It should not create any of many orders on database error"""
+        exception_mock.side_effect = Exception()
+        orders = OrderFactory.create_batch(2)
+        self.assertRaises(DataValidationError, Order.create_all, orders)
+
+    @patch("service.models.db.session.commit")
+    def test_transition_orders_failed(self, exception_mock):
+        """It should not move orders on database error"""
+        exception_mock.side_effect = Exception()
+        self.assertRaises(DataValidationError, Order.transition, 0, [1])
+
     def test_deserialize_with_key_error(self):
         """It should not Deserialize an order with a KeyError"""
         order = Order()
         self.assertRaises(DataValidationError, order.deserialize, {})
 
+    def test_check_columns(self):
+        """It should only pass an Order whose values fit its columns"""
+        order = Order().deserialize(OrderFactory().serialize())
+        self.assertIs(order.check_columns(), order)
+        for key, value in (
+            ("address", "x" * 65),
+            ("customer_id", -(2**31) - 1),
+            ("status", True),
+            ("amount", "12"),
+            ("address", None),
+        ):
+            bad = Order().deserialize({**order.serialize(), key: value})
+            with self.assertRaises(DataValidationError) as context:
+                bad.check_columns()
+            self.assertIn(key, str(context.exception))
+
     def test_deserialize_with_type_error(self):
         """It should not Deserialize an order with a TypeError"""
         order = Order()
         self.assertRaises(DataValidationError, order.deserialize, [])
+
+    def test_deserialize_with_bad_date(self):
+        """It should not Deserialize an order with a date that is not ISO 8601"""
+        data = OrderFactory().serialize()
+        data["date"] = "yesterday"
+        order = Order()
+        self.assertRaises(DataValidationError, order.deserialize, data)
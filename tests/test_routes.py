@@ -18,17 +18,24 @@
 TestYourResourceModel API Service Test Suite
 """
 
-# pylint: disable=duplicate-code
+# pylint: disable=duplicate-code, too-many-lines
 # test commit for pipeline 1 1 1 1
 import os
+import gzip
+import json
 import logging
+import uuid
 from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
+import msgpack
 
 # from urllib.parse import quote_plus
 from wsgi import app
 from service.common import status
-from service.models import db, Order
+from service.routes import DEFAULT_PAGE_SIZE
+from service.models import db, Order, IdempotencyKey, cache, responses
+from service.models import VersionConflictError
 from .factories import OrderFactory, ItemFactory
 
 DATABASE_URI = os.getenv(
@@ -64,7 +71,11 @@ class OrderTestSuite(TestCase):
         """Runs before each test"""
         self.client = app.test_client()
         db.session.query(Order).delete()  # clean up the last tests
+        db.session.query(IdempotencyKey).delete()
         db.session.commit()
+        # the deletes above bypass the invalidation of the caches
+        cache.clear()
+        responses.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -123,6 +134,8 @@ class OrderTestSuite(TestCase):
         """It should call the health endpoint"""
         resp = self.client.get("/health")
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(resp.get_json()["cache"]), {"hits", "misses", "size"})
+        self.assertEqual(set(resp.get_json()["responses"]), {"hits", "misses", "size"})
 
     # ----------------------------------------------------------
     # TEST CREATE
@@ -160,6 +173,159 @@ class OrderTestSuite(TestCase):
         self.assertEqual(new_order["address"], test_order.address)
         self.assertEqual(new_order["customer_id"], test_order.customer_id)
 
+    def test_create_order_idempotent(self):
+        """It should create an Order once however often the request is retried"""
+        data = OrderFactory().serialize()
+        headers = {"Idempotency-Key": "order-1"}
+        first = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        resp = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(resp.headers["Location"], first.headers["Location"])
+        self.assertEqual(resp.get_json(), first.get_json())
+        self.assertEqual(len(Order.all()), 1)
+        # the same key with another request is a mistake
+        data["address"] = "somewhere else"
+        resp = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        resp = self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": ""})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(Order.all()), 1)
+
+    def test_create_order_idempotent_in_progress(self):
+        """It should not handle a retry while the first request is in progress"""
+        data = OrderFactory().serialize()
+        with patch(
+            "service.routes.IdempotencyKey.complete", side_effect=Exception("gone")
+        ):
+            self.assertRaises(
+                Exception,
+                self.client.post,
+                BASE_URL,
+                json=data,
+                headers={"Idempotency-Key": "order-1"},
+            )
+        resp = self.client.post(
+            BASE_URL, json=data, headers={"Idempotency-Key": "order-1"}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        # once the lease of the first request is up a retry takes its place
+        db.session.execute(db.update(IdempotencyKey).values(expires_at=db.func.now()))
+        db.session.commit()
+        resp = self.client.post(
+            BASE_URL, json=data, headers={"Idempotency-Key": "order-1"}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def test_create_order_idempotent_failure(self):
+        """It should let the key of a request that failed be used again"""
+        headers = {"Idempotency-Key": "order-1"}
+        resp = self.client.post(BASE_URL, json={"status": 1}, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post(BASE_URL, json={"status": 1}, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn("Idempotent-Replayed", resp.headers)
+        data = OrderFactory().serialize()
+        resp = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def test_create_order_with_items(self):
+        """It should Create a new Order together with its Items"""
+        data = OrderFactory().serialize()
+        data["items"] = [
+            {"product_id": 1, "price": 2, "quantity": 3},
+            {"product_id": 2, "price": 1.5, "quantity": 2},
+        ]
+        response = self.client.post(BASE_URL, json=data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.get_json()["amount"], 9)
+        location = response.headers["Location"]
+        response = self.client.get(location, query_string="expand=items")
+        items = response.get_json()["items"]
+        self.assertEqual(sorted(item["product_id"] for item in items), [1, 2])
+
+    def test_create_order_with_items_without_amount(self):
+        """It should only leave out the amount when creating an Order with Items"""
+        data = OrderFactory().serialize()
+        del data["amount"]
+        data["items"] = [{"product_id": 1, "price": 2, "quantity": 3}]
+        response = self.client.post(BASE_URL, json=data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.get_json()["amount"], 6)
+        # an update still needs the amount, which its Items do not set
+        url = response.headers["Location"]
+        response = self.client.put(url, json=data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url).get_json()["amount"], 6)
+
+    def test_create_order_with_invalid_items(self):
+        """It should not Create an Order when any of its Items is not valid"""
+        data = OrderFactory().serialize()
+        line = {"product_id": 1, "price": 2, "quantity": 3}
+        for items in ["items", ["item"], [{"product_id": 1}], [line, line]]:
+            response = self.client.post(BASE_URL, json={**data, "items": items})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL)
+        self.assertEqual(response.get_json(), [])
+
+    def test_create_order_batch(self):
+        """It should Create many Orders at once"""
+        test_orders = OrderFactory.create_batch(3)
+        response = self.client.post(
+            f"{BASE_URL}/batch", json=[order.serialize() for order in test_orders]
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        results = response.get_json()
+        self.assertEqual(len(results), 3)
+        for result, test_order in zip(results, test_orders):
+            self.assertEqual(result["status"], status.HTTP_201_CREATED)
+            response = self.client.get(f"{BASE_URL}/{result['id']}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()["address"], test_order.address)
+
+    def test_create_order_batch_with_invalid_orders(self):
+        """It should Create the valid Orders of a batch and report the others"""
+        good, bad = [order.serialize() for order in OrderFactory.create_batch(2)]
+        del bad["address"]
+        response = self.client.post(f"{BASE_URL}/batch", json=[bad, good, "order"])
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.get_json()
+        self.assertEqual(
+            [result["status"] for result in results],
+            [
+                status.HTTP_400_BAD_REQUEST,
+                status.HTTP_201_CREATED,
+                status.HTTP_400_BAD_REQUEST,
+            ],
+        )
+        self.assertIn("address", results[0]["error"])
+        response = self.client.get(BASE_URL)
+        self.assertEqual(
+            [order["id"] for order in response.get_json()], [results[1]["id"]]
+        )
+
+    def test_create_order_batch_with_values_too_large(self):
+        """It should only turn away the Orders whose values do not fit their columns"""
+        orders = [OrderFactory().serialize() for _ in range(4)]
+        orders[0]["address"] = "x" * 65
+        orders[1]["customer_id"] = 2**31
+        orders[2]["status"] = "1"
+        response = self.client.post(f"{BASE_URL}/batch", json=orders)
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.get_json()
+        self.assertEqual(
+            [result["status"] for result in results],
+            [status.HTTP_400_BAD_REQUEST] * 3 + [status.HTTP_201_CREATED],
+        )
+        for result, name in zip(results, ("address", "customer_id", "status")):
+            self.assertIn(name, result["error"])
+        response = self.client.get(BASE_URL)
+        self.assertEqual(
+            [order["id"] for order in response.get_json()], [results[3]["id"]]
+        )
+
     # ----------------------------------------------------------
     # TEST READ
     # ----------------------------------------------------------
@@ -174,6 +340,180 @@ class OrderTestSuite(TestCase):
         data = resp.get_json()
         self.assertEqual(data["id"], order.id)
 
+    def test_get_order_from_response_cache(self):
+        """It should return the same Order again without reading it until it changes"""
+        order = self._create_orders(1)[0]
+        first = self.client.get(f"{BASE_URL}/{order.id}")
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        with patch("service.routes.Order.find", side_effect=AssertionError):
+            resp = self.client.get(f"{BASE_URL}/{order.id}")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_data(), first.get_data())
+            self.assertEqual(resp.content_type, "application/json")
+        resp = self.client.get(f"{BASE_URL}/{order.id}", headers={"X-Fields": "id"})
+        self.assertEqual(resp.get_json(), {"id": order.id})
+        resp = self.client.get(f"{BASE_URL}/{order.id}", query_string="expand=items")
+        self.assertEqual(resp.get_json()["items"], [])
+        # adding an Item changes the Order and drops its cached responses
+        item = self._create_items(order)[0]
+        resp = self.client.get(f"{BASE_URL}/{order.id}", query_string="expand=items")
+        self.assertEqual(resp.get_json()["items"][0]["product_id"], item.product_id)
+        data = first.get_json()
+        data["address"] = "somewhere else"
+        self.client.put(f"{BASE_URL}/{order.id}", json=data)
+        resp = self.client.get(f"{BASE_URL}/{order.id}")
+        self.assertEqual(resp.get_json()["address"], "somewhere else")
+
+    def test_get_order_response_variants_bounded(self):
+        """It should cache a bounded number of variants of an Order's response"""
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}"
+        key = Order.cache_key(order.id)
+        # masks that are only written differently are one variant
+        for mask in ("id,amount", "id, amount", "{id,amount}"):
+            self.client.get(url, headers={"X-Fields": mask})
+        self.assertEqual(len(responses.get(key)), 1)
+        with patch.dict(app.config, {"RESPONSE_CACHE_VARIANTS": 2}):
+            for mask in ("id", "amount", "status"):
+                resp = self.client.get(url, headers={"X-Fields": mask})
+                self.assertEqual(list(resp.get_json()), [mask])
+        self.assertEqual(len(responses.get(key)), 2)
+
+    def test_get_order_not_modified(self):
+        """It should answer 304 Not Modified for an Order the client already has"""
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}"
+        resp = self.client.get(url)
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith('"'))
+        with patch("service.routes.Order.find", side_effect=AssertionError):
+            resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.get_data(), b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+        resp = self.client.get(url, headers={"If-None-Match": '"other"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        data["address"] = "somewhere else"
+        self.client.put(url, json=data)
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_list_orders_not_modified(self):
+        """It should answer 304 Not Modified for a list of Orders that has not changed"""
+        self._create_orders(2)
+        resp = self.client.get(BASE_URL)
+        etag = resp.headers["ETag"]
+        resp = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self._create_orders(1)
+        resp = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_list_orders_not_modified_before_reading(self):
+        """It should answer 304 Not Modified without reading the page of Orders"""
+        orders = self._create_orders(2)
+        url = f"{BASE_URL}?limit=2"
+        etag = self.client.get(url).headers["ETag"]
+        with patch("service.routes.Order.page_rows", side_effect=AssertionError):
+            resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers["ETag"], etag)
+        # other fields or another page are another ETag
+        resp = self.client.get(url, headers={"X-Fields": "id"})
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp = self.client.get(f"{BASE_URL}?limit=1")
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        # changing an Order that is not the newest changes the page too
+        data = self.client.get(f"{BASE_URL}/{orders[0].id}").get_json()
+        data["address"] = "somewhere else"
+        self.client.put(f"{BASE_URL}/{orders[0].id}", json=data)
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_update_order_if_match(self):
+        """It should only change an Order that is still at the version in If-Match"""
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}"
+        resp = self.client.get(url)
+        self.assertEqual(resp.headers["ETag"], '"1"')
+        self.assertIn("X-Fields", resp.headers["Vary"])
+        data = resp.get_json()
+        data["status"] = 1
+        data["address"] = "somewhere else"
+        resp = self.client.put(url, json=data, headers={"If-Match": '"0"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.client.put(url, json=data, headers={"If-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"2"')
+        for resp in (
+            self.client.put(f"{url}/cancel", headers={"If-Match": '"1"'}),
+            self.client.delete(url, headers={"If-Match": '"1"'}),
+        ):
+            self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.client.put(f"{url}/cancel", headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"3"')
+        resp = self.client.delete(url, headers={"If-Match": '"3"'})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_order_variants_etags(self):
+        """It should tag each variant of an Order with its own ETag of its version"""
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}"
+        etags = {
+            self.client.get(url, headers=headers).headers["ETag"]
+            for headers in (
+                {},
+                {"X-Fields": "id"},
+                {"Accept": "application/msgpack"},
+            )
+        }
+        self.assertEqual(len(etags), 3)
+        self.assertIn('"1"', etags)
+        resp = self.client.get(url, headers={"If-None-Match": '"1"', "X-Fields": "id"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # If-Match takes the ETag of any variant at the version
+        etag = self.client.get(url, headers={"X-Fields": "id"}).headers["ETag"]
+        data = self.client.get(url).get_json()
+        # a PUT that changes nothing leaves the version as it is
+        data["address"] = "somewhere else"
+        resp = self.client.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_update_changed_order(self):
+        """It should not change an Order someone else changed while it was read"""
+        order = self._create_orders(1)[0]
+        url = f"{BASE_URL}/{order.id}"
+        data = self.client.get(url).get_json()
+        with patch(
+            "service.routes.Order.update", side_effect=VersionConflictError("changed")
+        ):
+            resp = self.client.put(url, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(resp.get_json()["message"], "changed")
+
+    def test_get_order_expand_items(self):
+        """It should Read a single order with its items embedded"""
+        order = self._create_orders(1)[0]
+        items = self._create_items(order, 2)
+        resp = self.client.get(f"{BASE_URL}/{order.id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("items", resp.get_json())
+        resp = self.client.get(f"{BASE_URL}/{order.id}", query_string="expand=items")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["id"], order.id)
+        self.assertEqual(
+            sorted(item["product_id"] for item in data["items"]),
+            sorted(item.product_id for item in items),
+        )
+
     def test_get_order_not_found(self):
         """It should not Read an Order that is not found"""
         resp = self.client.get(f"{BASE_URL}/-100")
@@ -242,6 +582,92 @@ class OrderTestSuite(TestCase):
         dates = [order["date"] for order in data]
         self.assertEqual(dates, sorted(dates, reverse=True))
 
+    def test_get_orders_by_page(self):
+        """It should page through all orders newest first with a cursor"""
+        self._create_orders(5)
+        seen = []
+        url = f"{BASE_URL}?limit=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertLessEqual(len(data), 2)
+            seen.extend(data)
+            link = response.headers.get("Link")
+            url = link.split(">")[0].lstrip("<") if link else None
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len({order["id"] for order in seen}), 5)
+        keys = [(order["date"], order["id"]) for order in seen]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_get_last_page(self):
+        """It should not link to a next page when the page is not full"""
+        self._create_orders(2)
+        response = self.client.get(BASE_URL, query_string="limit=3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertNotIn("Link", response.headers)
+
+    def test_get_orders_default_page(self):
+        """It should return a page of the default size when no limit is given"""
+        db.session.add_all(OrderFactory.create_batch(DEFAULT_PAGE_SIZE + 1))
+        db.session.commit()
+        response = self.client.get(BASE_URL)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), DEFAULT_PAGE_SIZE)
+        link = response.headers["Link"]
+        response = self.client.get(link.split(">")[0].lstrip("<"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertNotIn("Link", response.headers)
+
+    def test_get_orders_fields(self):
+        """It should return only the fields asked for"""
+        self._create_orders(3)
+        response = self.client.get(BASE_URL, query_string="fields=id,status")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), 3)
+        for order in data:
+            self.assertEqual(set(order), {"id", "status"})
+
+    def test_get_orders_fields_by_page(self):
+        """It should page through orders returning only some fields"""
+        self._create_orders(3)
+        response = self.client.get(BASE_URL, query_string="fields=status&limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), 2)
+        for order in data:
+            self.assertEqual(set(order), {"status"})
+        self.assertIn("Link", response.headers)
+
+    def test_get_orders_expand_items(self):
+        """It should embed the items of every order when expanded"""
+        orders = self._create_orders(2)
+        items = {order.id: self._create_items(order, 2) for order in orders}
+        response = self.client.get(BASE_URL, query_string="expand=items")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), 2)
+        for order in data:
+            self.assertEqual(
+                sorted(item["product_id"] for item in order["items"]),
+                sorted(item.product_id for item in items[order["id"]]),
+            )
+
+    def test_get_orders_expand_items_fields(self):
+        """It should embed items alongside only the fields asked for"""
+        order = self._create_orders(1)[0]
+        self._create_items(order, 1)
+        response = self.client.get(
+            BASE_URL, query_string="fields=id&expand=items&limit=5"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(set(data[0]), {"id", "items"})
+        self.assertEqual(len(data[0]["items"]), 1)
+
     def test_get_all_orders_empty(self):
         """Return empty list with status code 200 when there is no order"""
         response = self.client.get(f"{BASE_URL}")
@@ -249,6 +675,34 @@ class OrderTestSuite(TestCase):
         data = response.get_json()
         self.assertEqual(data, [])
 
+    # ----------------------------------------------------------
+    # TEST EXPORT
+    # ----------------------------------------------------------
+    def test_export_orders(self):
+        """It should stream all orders as newline-delimited JSON"""
+        orders = self._create_orders(3)
+        response = self.client.get(f"{BASE_URL}/export")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        data = [json.loads(line) for line in lines]
+        self.assertEqual(
+            {order["id"] for order in data}, {order.id for order in orders}
+        )
+        dates = [order["date"] for order in data]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+    def test_export_orders_with_filter(self):
+        """It should stream only the orders matching the filters"""
+        orders = self._create_orders(3)
+        response = self.client.get(
+            f"{BASE_URL}/export", query_string={"customer_id": orders[0].customer_id}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])["id"], orders[0].id)
+
     # ----------------------------------------------------------
     # TEST ACTIONS
     # ----------------------------------------------------------
@@ -277,6 +731,41 @@ class OrderTestSuite(TestCase):
     #  I T E M   T E S T   C A S E S
     ######################################################################
 
+    def test_cancel_orders(self):
+        """It should Cancel many Orders by id or by query"""
+        orders = OrderFactory.create_batch(4, status=1)
+        ids = [
+            self.client.post(BASE_URL, json=order.serialize()).get_json()["id"]
+            for order in orders
+        ]
+        self.client.put(f"{BASE_URL}/{ids[1]}/cancel")
+        resp = self.client.put(f"{BASE_URL}/cancel", json={"ids": ids[:2]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"ids": [ids[0]]})
+        customer_id = orders[2].customer_id
+        resp = self.client.put(
+            f"{BASE_URL}/cancel", query_string=f"customer_id={customer_id}"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"ids": [ids[2]]})
+        resp = self.client.get(BASE_URL, query_string="status=0")
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_transition_orders(self):
+        """It should move many Orders to another status"""
+        orders = OrderFactory.create_batch(3, status=1)
+        orders[2].status = 3
+        ids = [
+            self.client.post(BASE_URL, json=order.serialize()).get_json()["id"]
+            for order in orders
+        ]
+        self.client.put(f"{BASE_URL}/{ids[0]}/cancel")
+        resp = self.client.put(f"{BASE_URL}/status", json={"ids": ids, "status": 3})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"ids": [ids[1]]})
+        resp = self.client.get(f"{BASE_URL}/{ids[0]}")
+        self.assertEqual(resp.get_json()["status"], 0)
+
     # ----------------------------------------------------------
     # TEST CREATE AN ITEM
     # ----------------------------------------------------------
@@ -331,6 +820,28 @@ class OrderTestSuite(TestCase):
         data = resp.get_json()
         self.assertEqual(data["amount"], float(test_item.amount()))
 
+    def test_upsert_item_batch(self):
+        """It should add and replace many Items of an Order at once"""
+        order = self._create_orders(1)[0]
+        resp = self.client.post(
+            f"{BASE_URL}/{order.id}/items",
+            json={"order_id": order.id, "product_id": 1, "price": 5, "quantity": 1},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        lines = [
+            {"product_id": 1, "price": 2, "quantity": 3},
+            {"product_id": 2, "price": 1.5, "quantity": 2},
+        ]
+        resp = self.client.post(f"{BASE_URL}/{order.id}/items/batch", json=lines)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            resp.get_json(), [{**line, "order_id": order.id} for line in lines]
+        )
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items")
+        self.assertEqual(len(resp.get_json()), 2)
+        resp = self.client.get(f"{BASE_URL}/{order.id}")
+        self.assertEqual(resp.get_json()["amount"], 9)
+
     def test_list_items(self):
         """It should Get a list of Items"""
         # add two addresses to order
@@ -359,6 +870,113 @@ class OrderTestSuite(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 2)
 
+    def test_list_items_fields(self):
+        """It should list only the Item fields asked for"""
+        order = self._create_orders(1)[0]
+        self._create_items(order, 2)
+        resp = self.client.get(
+            f"{BASE_URL}/{order.id}/items", query_string="fields=product_id,quantity"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        for item in data:
+            self.assertEqual(set(item), {"product_id", "quantity"})
+
+    def test_get_item_from_response_cache(self):
+        """It should return the same Item again without reading it until it changes"""
+        order = self._create_orders(1)[0]
+        item = self._create_items(order)[0]
+        url = f"{BASE_URL}/{order.id}/items/{item.product_id}"
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        with patch(
+            "service.routes.Item.find_by_product_id", side_effect=AssertionError
+        ):
+            resp = self.client.get(url)
+            self.assertEqual(resp.get_data(), first.get_data())
+        resp = self.client.get(url, headers={"X-Fields": "quantity"})
+        self.assertEqual(resp.get_json(), {"quantity": item.quantity})
+        data = first.get_json()
+        data["quantity"] = item.quantity + 1
+        self.client.put(url, json=data)
+        self.assertEqual(self.client.get(url).get_json()["quantity"], item.quantity + 1)
+        self.client.delete(url)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_items_not_modified(self):
+        """It should answer 304 Not Modified for the Items of an Order that have not changed"""
+        order = self._create_orders(1)[0]
+        item = self._create_items(order)[0]
+        url = f"{BASE_URL}/{order.id}/items"
+        resp = self.client.get(url)
+        etag = resp.headers["ETag"]
+        with patch("service.routes.Item.find_serialized", side_effect=AssertionError):
+            resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.client.get(url, query_string=f"quantity={item.quantity}")
+        self.assertEqual(len(resp.get_json()), 1)
+        self._create_items(order)
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items/{item.product_id}")
+        resp = self.client.get(
+            f"{BASE_URL}/{order.id}/items/{item.product_id}",
+            headers={"If-None-Match": resp.headers["ETag"]},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_update_item_if_match(self):
+        """It should only change an Item that is still at the version in If-Match"""
+        order = self._create_orders(1)[0]
+        item = self._create_items(order)[0]
+        url = f"{BASE_URL}/{order.id}/items/{item.product_id}"
+        resp = self.client.get(url)
+        self.assertEqual(resp.headers["ETag"], '"1"')
+        # adding the Item changed its Order, whose Items are another variant
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items")
+        self.assertTrue(resp.headers["ETag"].startswith('"2-'))
+        data = self.client.get(url).get_json()
+        resp = self.client.put(url, json=data, headers={"If-Match": '"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.client.put(url, json=data, headers={"If-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"2"')
+        resp = self.client.delete(url, headers={"If-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.client.delete(url, headers={"If-Match": '"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_create_items_idempotent(self):
+        """It should add Items once however often the request is retried"""
+        order = self._create_orders(1)[0]
+        item = ItemFactory(order_id=order.id)
+        for _ in range(2):
+            resp = self.client.post(
+                f"{BASE_URL}/{order.id}/items",
+                json=item.serialize(),
+                headers={"Idempotency-Key": "item-1"},
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        lines = [{"product_id": 1, "price": 2, "quantity": 3}]
+        for _ in range(2):
+            resp = self.client.post(
+                f"{BASE_URL}/{order.id}/items/batch",
+                json=lines,
+                headers={"Idempotency-Key": "items-1"},
+            )
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Idempotent-Replayed"], "true")
+        for _ in range(2):
+            resp = self.client.post(
+                f"{BASE_URL}/batch",
+                json=[OrderFactory().serialize()] * 2,
+                headers={"Idempotency-Key": "orders-1"},
+            )
+        self.assertEqual(resp.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(len(Order.all()), 3)
+
     def test_get_item(self):
         """It should Get an item from an order"""
         # create a known item
@@ -518,6 +1136,20 @@ class OrderTestSuite(TestCase):
         address = data[0]["address"]
         self.assertEqual(address, orders[0].address)
 
+    def test_query_orders_by_many_filters(self):
+        """It should query orders matching all of the filters"""
+        for status_code in (0, 0, 1):
+            order = OrderFactory(customer_id=5, status=status_code)
+            order.create()
+        OrderFactory(customer_id=6, status=0).create()
+        resp = self.client.get(BASE_URL, query_string="customer_id=5&status=0")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        for order in data:
+            self.assertEqual(order["customer_id"], 5)
+            self.assertEqual(order["status"], 0)
+
     def test_query_items_by_price(self):
         """It should Query Items by Price"""
         # create an order
@@ -569,6 +1201,118 @@ class OrderTestSuite(TestCase):
             self.assertEqual(item["quantity"], test_quantity)
         self.assertEqual(len(data), quantity_count)
 
+    def test_create_order_msgpack(self):
+        """It should Create and Read Orders and Items in MessagePack"""
+        msgpack_headers = {
+            "Content-Type": "application/msgpack",
+            "Accept": "application/msgpack",
+        }
+        order = OrderFactory().serialize()
+        response = self.client.post(
+            BASE_URL, data=msgpack.packb(order), headers=msgpack_headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.content_type, "application/msgpack")
+        created = msgpack.unpackb(response.get_data())
+        self.assertEqual(created["address"], order["address"])
+        item = {"order_id": created["id"], "product_id": 1, "price": 2.5, "quantity": 2}
+        response = self.client.post(
+            f"{BASE_URL}/{created['id']}/items",
+            data=msgpack.packb(item),
+            headers=msgpack_headers,
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(msgpack.unpackb(response.get_data()), item)
+        for url in (BASE_URL, f"{BASE_URL}/{created['id']}/items"):
+            response = self.client.get(url, headers={"Accept": "application/msgpack"})
+            self.assertEqual(response.content_type, "application/msgpack")
+            self.assertEqual(len(msgpack.unpackb(response.get_data())), 1)
+        response = self.client.get(f"{BASE_URL}/{created['id']}")
+        self.assertEqual(response.get_json()["amount"], 5.0)
+
+    def test_list_orders_gzipped(self):
+        """It should gzip large listings and exports for clients that accept it"""
+        order = self._create_orders(1)[0]
+        self._create_items(order, 2)
+        gzipped = {"Accept-Encoding": "gzip"}
+        urls = (BASE_URL, f"{BASE_URL}/{order.id}/items", f"{BASE_URL}/export")
+        with patch.dict(app.config, {"COMPRESS_MIN_SIZE": 1}):
+            for url in urls:
+                response = self.client.get(url, headers=gzipped)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.headers["Content-Encoding"], "gzip")
+                self.assertIn("Accept-Encoding", response.vary)
+                # a stream is read to its end before the next request is made
+                body = gzip.decompress(response.get_data())
+                plain = self.client.get(url)
+                self.assertNotIn("Content-Encoding", plain.headers)
+                self.assertEqual(body, plain.get_data())
+            etag = self.client.get(BASE_URL, headers=gzipped).headers["ETag"]
+            self.assertTrue(etag.startswith("W/"))
+            response = self.client.get(
+                BASE_URL, headers={**gzipped, "If-None-Match": etag}
+            )
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        # small listings are not worth compressing
+        response = self.client.get(BASE_URL, headers=gzipped)
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_create_orders_gzipped(self):
+        """It should Create Orders from gzipped bodies"""
+        orders = [order.serialize() for order in OrderFactory.create_batch(3)]
+        body = json.dumps(orders).encode()
+        key = str(uuid.uuid4())
+        headers = {"Content-Encoding": "gzip", "Idempotency-Key": key}
+        response = self.client.post(
+            f"{BASE_URL}/batch",
+            data=gzip.compress(body),
+            content_type="application/json",
+            headers=headers,
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # the same request sent without gzip is the same request
+        response = self.client.post(
+            f"{BASE_URL}/batch",
+            data=body,
+            content_type="application/json",
+            headers={"Idempotency-Key": key},
+        )
+        self.assertEqual(response.headers["Idempotent-Replayed"], "true")
+        response = self.client.post(
+            BASE_URL,
+            data=gzip.compress(msgpack.packb(orders[0])),
+            content_type="application/msgpack",
+            headers={"Content-Encoding": "gzip"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(Order.all()), 4)
+
+    def test_create_order_bad_gzip(self):
+        """It should not Create an Order from a bad or too large gzipped body"""
+        body = json.dumps(OrderFactory().serialize()).encode()
+        bodies = {
+            b"not gzip": status.HTTP_400_BAD_REQUEST,
+            gzip.compress(body)[:-10]: status.HTTP_400_BAD_REQUEST,
+            gzip.compress(body + b" " * 100): status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        }
+        with patch.dict(app.config, {"MAX_DECOMPRESSED_SIZE": len(body) + 50}):
+            for data, code in bodies.items():
+                response = self.client.post(
+                    BASE_URL,
+                    data=data,
+                    content_type="application/json",
+                    headers={"Content-Encoding": "gzip"},
+                )
+                self.assertEqual(response.status_code, code)
+        response = self.client.post(
+            BASE_URL,
+            data=body,
+            content_type="application/json",
+            headers={"Content-Encoding": "br"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        self.assertEqual(Order.all(), [])
+
 
 ######################################################################
 #  T E S T   S A D   P A T H S
@@ -603,6 +1347,13 @@ class TestSadPaths(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_create_order_bad_msgpack(self):
+        """It should not Create an Order from a body that is not MessagePack"""
+        response = self.client.post(
+            BASE_URL, data=b"\xc1", content_type="application/msgpack"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_create_order_bad_available(self):
         """It should not Create an Order with bad available data"""
         test_order = OrderFactory()
@@ -612,6 +1363,47 @@ class TestSadPaths(TestCase):
         response = self.client.post(BASE_URL, json=test_order.serialize())
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_create_order_batch_not_a_list(self):
+        """It should not Create a batch of Orders that is not a list"""
+        order = OrderFactory()
+        response = self.client.post(f"{BASE_URL}/batch", json=order.serialize())
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/batch", json=[])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch("service.routes.MAX_BATCH_SIZE", 2)
+    def test_create_order_batch_too_large(self):
+        """It should not Create a batch of more Orders than allowed"""
+        orders = [order.serialize() for order in OrderFactory.create_batch(3)]
+        response = self.client.post(f"{BASE_URL}/batch", json=orders)
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_create_order_batch_wrong_content_type(self):
+        """It should not Create a batch of Orders with wrong content type"""
+        response = self.client.post(
+            f"{BASE_URL}/batch", data="[]", content_type="text/html"
+        )
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_transition_orders_bad_data(self):
+        """It should not move Orders that are not chosen correctly"""
+        for data in [{}, {"ids": "1"}, {"ids": [True]}, [1]]:
+            resp = self.client.put(f"{BASE_URL}/cancel", json=data)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.put(f"{BASE_URL}/cancel")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for data in [
+            {"ids": [1]},
+            {"ids": [1], "status": 4},
+            {"ids": [1], "status": True},
+        ]:
+            resp = self.client.put(f"{BASE_URL}/status", json=data)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.put(
+            f"{BASE_URL}/cancel", data='{"ids": [1]}', content_type="text/html"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
     def test_query_order_with_invalid_date(self):
         """It should not query an Order with invalid date string"""
         test_order = OrderFactory()
@@ -619,6 +1411,30 @@ class TestSadPaths(TestCase):
         response = self.client.get(BASE_URL, query_string="date=xxx")
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_query_order_with_invalid_limit(self):
+        """It should not query Orders with a limit out of range"""
+        response = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="limit=100000")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_order_with_invalid_expand(self):
+        """It should not expand an Order by something it does not have"""
+        response = self.client.get(BASE_URL, query_string="expand=customer")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_order_with_invalid_cursor(self):
+        """It should not query Orders with a cursor it did not issue"""
+        response = self.client.get(BASE_URL, query_string="limit=1&cursor=xxx")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_order_with_invalid_fields(self):
+        """It should not query Orders for fields they do not have"""
+        response = self.client.get(BASE_URL, query_string="fields=id,colour")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="fields=,")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_items_not_available(self):
         """It should not Get items if order does not exist"""
         resp = self.client.get(
@@ -643,6 +1459,31 @@ class TestSadPaths(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_upsert_item_batch_not_available(self):
+        """It should not add a batch of Items if the order does not exist"""
+        resp = self.client.post(
+            f"{BASE_URL}/100/items/batch",
+            json=[{"product_id": 1, "price": 2, "quantity": 3}],
+        )
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_upsert_item_batch_bad_data(self):
+        """It should not add a batch of Items that is not valid"""
+        order = OrderFactory()
+        order.create()
+        url = f"{BASE_URL}/{order.id}/items/batch"
+        line = {"product_id": 1, "price": 2, "quantity": 3}
+        for data in [line, [], ["item"], [{"product_id": 1}], [line, line]]:
+            resp = self.client.post(url, json=data)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post(url, data="[]", content_type="text/html")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        with patch("service.routes.MAX_BATCH_SIZE", 1):
+            resp = self.client.post(url, json=[line, line])
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        resp = self.client.get(f"{BASE_URL}/{order.id}/items")
+        self.assertEqual(resp.get_json(), [])
+
     def test_create_items_not_available(self):
         """It should not Create items if order does not exist"""
         resp = self.client.post(
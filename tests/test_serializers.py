@@ -0,0 +1,107 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the compiled Serializers
+"""
+
+from datetime import date
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import TestCase
+from flask_restx import Model, fields, marshal
+from service.common.serializers import Serializer
+
+line_model = Model(
+    "Line",
+    {
+        "product_id": fields.Integer,
+        "price": fields.Float,
+    },
+)
+
+parent_model = Model(
+    "Parent",
+    {
+        "id": fields.Integer,
+        "date": fields.Date,
+        "amount": fields.Float,
+        "address": fields.String,
+        "lines": fields.List(fields.Nested(line_model)),
+    },
+)
+
+child_model = parent_model.inherit("Child", {"done": fields.Boolean})
+
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializer(TestCase):
+    """Test Cases for Serializer"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.record = SimpleNamespace(
+            id=1,
+            date=date(2024, 10, 12),
+            amount=Decimal("12.50"),
+            address="abc",
+            lines=[{"product_id": 7, "price": Decimal("2.5")}],
+            done=1,
+        )
+
+    def test_serialize_like_marshal(self):
+        """It should make what marshal() makes of a record and a dictionary"""
+        serializer = Serializer(parent_model)
+        expected = marshal(self.record, parent_model)
+        self.assertEqual(serializer(self.record), expected)
+        self.assertEqual(serializer(vars(self.record)), expected)
+        self.assertEqual(serializer([self.record] * 2), [expected] * 2)
+
+    def test_serialize_inherited_model(self):
+        """It should serialize the fields a model inherits"""
+        data = Serializer(child_model)(self.record)
+        self.assertEqual(data, marshal(self.record, child_model))
+        self.assertIs(data["done"], True)
+
+    def test_serialize_missing_values(self):
+        """It should serialize missing and None values as None"""
+        data = Serializer(parent_model)({"id": None})
+        self.assertEqual(data, marshal({"id": None}, parent_model))
+        self.assertIsNone(data["lines"])
+
+    def test_serialize_masked(self):
+        """It should keep only the fields of a mask, nested ones included"""
+        serializer = Serializer(parent_model)
+        mask = "amount,lines{price}"
+        masked = serializer.masked(mask)
+        self.assertIs(serializer.masked(mask), masked)
+        self.assertIs(serializer.masked(None), serializer)
+        data = masked(self.record)
+        self.assertEqual(data, {"amount": 12.5, "lines": [{"price": 2.5}]})
+        self.assertEqual(data, marshal(self.record, parent_model, mask=mask))
+
+    def test_serialize_masked_like_marshal(self):
+        """It should skip unknown fields and expand * in a mask as marshal() does"""
+        serializer = Serializer(parent_model)
+        for mask in ("id,bogus", "*", "address,*", "lines{bogus,price}"):
+            self.assertEqual(
+                serializer.masked(mask)(self.record),
+                marshal(self.record, parent_model, mask=mask),
+            )
+        self.assertEqual(serializer.masked("id,bogus")(self.record), {"id": 1})
+        self.assertEqual(list(serializer.masked("*")(self.record)), list(parent_model))